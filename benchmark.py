@@ -0,0 +1,383 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+"""
+=====================================================
+BENCHMARK DO SERVIDOR DE CONTROLE DE ACESSO
+Simula uma frota de ESP32 contra um banco temporário
+=====================================================
+
+Uso:
+    python benchmark.py carga --maquinas 40 --duracao 60 --saida carga.json
+    python benchmark.py micro --linhas 10000,1000000,10000000 --saida micro.json
+
+Os resultados são gravados em JSON para comparar execuções.
+"""
+
+import argparse
+import http.client
+import json
+import os
+import platform
+import random
+import shutil
+import socket
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+
+SERVIDOR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py')
+
+# ==================== UTILITÁRIOS ====================
+
+def percentis(amostras):
+    """count, média e p50/p95/p99 (ms) de uma lista de durações em segundos"""
+    if not amostras:
+        return {'total': 0}
+    ordenadas = sorted(amostras)
+
+    def p(fracao):
+        indice = min(len(ordenadas) - 1, int(round(fracao * (len(ordenadas) - 1))))
+        return round(ordenadas[indice] * 1000, 3)
+
+    return {
+        'total': len(ordenadas),
+        'media_ms': round(sum(ordenadas) / len(ordenadas) * 1000, 3),
+        'p50_ms': p(0.50),
+        'p95_ms': p(0.95),
+        'p99_ms': p(0.99),
+        'max_ms': round(ordenadas[-1] * 1000, 3)
+    }
+
+def porta_livre():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+def ambiente():
+    return {
+        'data': time.strftime('%Y-%m-%d %H:%M:%S'),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'plataforma': platform.platform(),
+        'cpus': os.cpu_count()
+    }
+
+def gravar_resultado(resultado, caminho):
+    if caminho:
+        with open(caminho, 'w', encoding='utf-8') as arquivo:
+            json.dump(resultado, arquivo, ensure_ascii=False, indent=2)
+        print(f'💾 Resultado salvo em {caminho}')
+
+# ==================== TESTE DE CARGA ====================
+
+class Coletor:
+    """Latências e erros por endpoint, compartilhados entre as threads"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latencias = {}
+        self.erros = {}
+
+    def registrar(self, endpoint, duracao, ok):
+        with self.lock:
+            if ok:
+                self.latencias.setdefault(endpoint, []).append(duracao)
+            else:
+                self.erros[endpoint] = self.erros.get(endpoint, 0) + 1
+
+class OrigemHandler(urllib.request.HTTPHandler):
+    """Conexões saindo de um IP de loopback próprio (127.0.0.0/8 no Linux)"""
+
+    def __init__(self, ip):
+        super().__init__()
+        self.ip = ip
+
+    def http_open(self, pedido):
+        return self.do_open(http.client.HTTPConnection, pedido, source_address=(self.ip, 0))
+
+def ips_por_maquina(quantidade):
+    """Um IP de origem por máquina, como na frota real
+
+    O servidor cobra um token bucket por IP além do da máquina; com
+    todas saindo de 127.0.0.1, a frota simulada esbarraria no limite do IP.
+    """
+    try:
+        with socket.socket() as s:
+            s.bind(('127.0.0.2', 0))
+    except OSError:
+        print('⚠️ Sem IPs extras de loopback: todas as máquinas saem de 127.0.0.1')
+        return ['127.0.0.1'] * quantidade
+    return [f'127.0.{2 + i // 250}.{2 + i % 250}' for i in range(quantidade)]
+
+def requisitar(coletor, endpoint, url, dados=None, abridor=None):
+    corpo = json.dumps(dados).encode() if dados is not None else None
+    pedido = urllib.request.Request(url, data=corpo, headers={'Content-Type': 'application/json'})
+    inicio = time.perf_counter()
+    try:
+        abrir = abridor.open if abridor is not None else urllib.request.urlopen
+        with abrir(pedido, timeout=10) as resposta:
+            resposta.read()
+            ok = resposta.status < 400
+    except (urllib.error.URLError, OSError):
+        ok = False
+    coletor.registrar(endpoint, time.perf_counter() - inicio, ok)
+
+def simular_maquina(base, machine_id, ip, uids, args, coletor, fim):
+    """Chegadas de Poisson com a mistura de validações e logs configurada"""
+    taxa_total = args.taxa_validar + args.taxa_log
+    rng = random.Random(machine_id)
+    abridor = urllib.request.build_opener(OrigemHandler(ip))
+
+    while True:
+        espera = rng.expovariate(taxa_total)
+        if time.monotonic() + espera >= fim:
+            return
+        time.sleep(espera)
+
+        uid = rng.choice(uids) if rng.random() > args.fracao_negados else f'{rng.getrandbits(32):08X}'
+        if rng.random() < args.taxa_validar / taxa_total:
+            requisitar(coletor, 'validar', f'{base}/api/validar/{uid}?machine_id={machine_id}', abridor=abridor)
+        else:
+            requisitar(coletor, 'log', f'{base}/api/log', abridor=abridor, dados={
+                'timestamp': int(time.time()),
+                'machine_id': machine_id,
+                'uid': uid,
+                'evento': rng.choice(['MAQUINA_LIGADA', 'MAQUINA_DESLIGADA', 'ACESSO_NEGADO']),
+                'rssi': rng.randint(-90, -40),
+                'duracao': rng.randint(0, 3600)
+            })
+
+def simular_dashboard(base, args, coletor, fim):
+    """Dashboard aberto recarregando listas como no polling antigo"""
+    while time.monotonic() + args.intervalo_dashboard < fim:
+        time.sleep(args.intervalo_dashboard)
+        requisitar(coletor, 'dashboard_logs', f'{base}/api/logs?limite=50')
+        requisitar(coletor, 'dashboard_usuarios', f'{base}/api/usuarios')
+
+def cadastrar_usuarios(base, uids):
+    """Cadastro numa única importação NDJSON, sem esbarrar no limite de taxa
+
+    Cadastro incompleto muda a mistura de validações: qualquer falha
+    aborta o teste antes da medição.
+    """
+    corpo = ''.join(json.dumps({'uid': uid, 'nome': f'Operador {uid}'}) + '\n' for uid in uids)
+    pedido = urllib.request.Request(f'{base}/api/usuarios/import?formato=ndjson', data=corpo.encode(),
+                                    headers={'Content-Type': 'application/x-ndjson'})
+    try:
+        with urllib.request.urlopen(pedido, timeout=60) as resposta:
+            resultado = json.loads(resposta.read())
+    except (urllib.error.URLError, OSError) as e:
+        raise SystemExit(f'❌ Falha cadastrando usuários ({e}); teste abortado')
+    gravados = resultado['processadas'] - resultado['total_erros']
+    if gravados != len(uids):
+        raise SystemExit(f'❌ Cadastrados {gravados} de {len(uids)} usuários; teste abortado')
+
+def iniciar_servidor(diretorio, porta, producao):
+    comando = [sys.executable, SERVIDOR, '--porta', str(porta)]
+    if producao:
+        comando.append('--producao')
+    saida = open(os.path.join(diretorio, 'servidor.log'), 'w')
+    processo = subprocess.Popen(comando, cwd=diretorio, stdout=saida, stderr=subprocess.STDOUT)
+
+    base = f'http://127.0.0.1:{porta}'
+    prazo = time.monotonic() + 30
+    while time.monotonic() < prazo:
+        try:
+            urllib.request.urlopen(f'{base}/api/cache', timeout=1).read()
+            return processo, base
+        except OSError:
+            if processo.poll() is not None:
+                break
+            time.sleep(0.2)
+    processo.kill()
+    raise SystemExit(f'❌ Servidor não subiu; veja {diretorio}/servidor.log')
+
+def teste_carga(args):
+    diretorio = tempfile.mkdtemp(prefix='scap-bench-')
+    processo, base = iniciar_servidor(diretorio, porta_livre(), args.producao)
+    print(f'🚀 Servidor em {base} (banco em {diretorio})')
+
+    try:
+        uids = [f'{0xB0000000 + i:08X}' for i in range(args.usuarios)]
+        cadastrar_usuarios(base, uids)
+
+        coletor = Coletor()
+        inicio = time.monotonic()
+        fim = inicio + args.duracao
+        threads = [
+            threading.Thread(target=simular_maquina,
+                             args=(base, f'BENCH-{i:03d}', ip, uids, args, coletor, fim))
+            for i, ip in enumerate(ips_por_maquina(args.maquinas))
+        ] + [
+            threading.Thread(target=simular_dashboard, args=(base, args, coletor, fim))
+            for _ in range(args.dashboards)
+        ]
+        print(f'📡 {args.maquinas} máquinas + {args.dashboards} dashboards por {args.duracao} s...')
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        decorrido = time.monotonic() - inicio
+
+        try:
+            with urllib.request.urlopen(f'{base}/metrics?formato=json', timeout=5) as r:
+                metricas_servidor = json.loads(r.read())
+        except OSError:
+            metricas_servidor = None
+    finally:
+        processo.terminate()
+        processo.wait(timeout=30)
+        shutil.rmtree(diretorio, ignore_errors=True)
+
+    endpoints = {}
+    for endpoint in sorted(set(coletor.latencias) | set(coletor.erros)):
+        resumo = percentis(coletor.latencias.get(endpoint, []))
+        resumo['erros'] = coletor.erros.get(endpoint, 0)
+        resumo['rps'] = round(resumo['total'] / decorrido, 2)
+        endpoints[endpoint] = resumo
+
+    resultado = {
+        'tipo': 'carga',
+        'ambiente': ambiente(),
+        'config': {k: v for k, v in vars(args).items() if k != 'func'},
+        'duracao_s': round(decorrido, 2),
+        'endpoints': endpoints,
+        'servidor': metricas_servidor
+    }
+
+    print(f'\n{"endpoint":<20}{"rps":>8}{"p50":>9}{"p95":>9}{"p99":>9}{"erros":>7}')
+    for endpoint, r in endpoints.items():
+        print(f'{endpoint:<20}{r["rps"]:>8}{r.get("p50_ms", "-"):>9}'
+              f'{r.get("p95_ms", "-"):>9}{r.get("p99_ms", "-"):>9}{r["erros"]:>7}')
+    gravar_resultado(resultado, args.saida)
+
+# ==================== MICROBENCHMARKS DO BANCO ====================
+
+def popular_logs(server, linhas, maquinas=50, usuarios=500):
+    """Inserir 'linhas' logs sintéticos em blocos, cobrindo ~1 ano"""
+    rng = random.Random(42)
+    agora = int(time.time())
+    bloco = 50000
+    with server.pool.conexao() as db:
+        for inicio in range(0, linhas, bloco):
+            registros = [
+                (agora - rng.randint(0, 365 * 86400), f'M{rng.randrange(maquinas):03d}',
+                 f'{rng.randrange(usuarios):08X}', None, rng.choice(['MAQUINA_LIGADA', 'MAQUINA_DESLIGADA']),
+                 rng.randint(-90, -40), rng.choice([0, 0, rng.randint(60, 3600)]), None)
+                for _ in range(min(bloco, linhas - inicio))
+            ]
+            db.executemany(server.SQL_INSERIR_LOG, registros)
+            db.commit()
+
+def cronometrar(funcao, repeticoes):
+    amostras = []
+    for _ in range(repeticoes):
+        inicio = time.perf_counter()
+        funcao()
+        amostras.append(time.perf_counter() - inicio)
+    return percentis(amostras)
+
+def microbenchmarks(args):
+    diretorio_original = os.getcwd()
+    sys.path.insert(0, os.path.dirname(SERVIDOR))
+    resultados = {}
+
+    for linhas in [int(n) for n in args.linhas.split(',')]:
+        diretorio = tempfile.mkdtemp(prefix='scap-micro-')
+        os.chdir(diretorio)
+        try:
+            import server
+            server.DATABASE = os.path.join(diretorio, 'controle_acesso.db')
+            server.pool = server.PoolConexoes(server.DATABASE, server.DB_POOL_TAMANHO)
+            server.RETENCAO_DIAS = None
+            server.retencao.dias = None
+            server.init_db()
+
+            print(f'\n📦 Populando {linhas:,} logs...')
+            inicio = time.perf_counter()
+            popular_logs(server, linhas)
+            print(f'   {time.perf_counter() - inicio:.1f} s')
+
+            agora = int(time.time())
+
+            def consulta(parametros, limite=50):
+                sql, params = server.consulta_logs(ArgsFalsos(parametros), limite)
+                return lambda: db.execute(sql, params).fetchall()
+
+            with server.pool.conexao() as db:
+                casos = {
+                    'logs_recentes': consulta({}),
+                    'logs_por_maquina': consulta({'machine_id': 'M007'}),
+                    'logs_por_uid': consulta({'uid': '00000042'}),
+                    'logs_before_ts': consulta({'before_ts': agora - 180 * 86400}),
+                    'logs_intervalo_dia': consulta({'desde': agora - 86400 * 30, 'ate': agora - 86400 * 29}, 1000),
+                    'contadores_o1': lambda: server.ler_contadores(db),
+                    'count_logs_varredura': lambda: db.execute('SELECT COUNT(*) FROM logs').fetchone(),
+                    'relatorio_diario_ano': lambda: db.execute(
+                        'SELECT dia, machine_id, SUM(segundos) FROM uso_diario WHERE dia >= ? '
+                        'GROUP BY dia, machine_id', (agora - 365 * 86400,)).fetchall(),
+                    'insert_commit_1': lambda: server.gravar_logs(db, [
+                        (agora, 'M000', 'BENCH', None, 'E', -50, 0, None)]),
+                    'insert_commit_100': lambda: server.gravar_logs(db, [
+                        (agora, 'M000', 'BENCH', None, 'E', -50, 0, None)] * 100),
+                }
+                resultados[linhas] = {}
+                for nome, funcao in casos.items():
+                    repeticoes = 3 if nome == 'count_logs_varredura' else args.repeticoes
+                    resultados[linhas][nome] = cronometrar(funcao, repeticoes)
+                    r = resultados[linhas][nome]
+                    print(f'   {nome:<24} p50 {r["p50_ms"]:>9} ms   p95 {r["p95_ms"]:>9} ms')
+            server.pool.fechar()
+        finally:
+            os.chdir(diretorio_original)
+            shutil.rmtree(diretorio, ignore_errors=True)
+
+    gravar_resultado({
+        'tipo': 'micro',
+        'ambiente': ambiente(),
+        'repeticoes': args.repeticoes,
+        'resultados': resultados
+    }, args.saida)
+
+class ArgsFalsos(dict):
+    """Imita request.args (get com type=) para reutilizar consulta_logs"""
+
+    def get(self, chave, default=None, type=None):
+        valor = super().get(chave, default)
+        if valor is not None and type is not None:
+            return type(valor)
+        return valor
+
+# ==================== CLI ====================
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark do servidor de controle de acesso')
+    sub = parser.add_subparsers(dest='comando', required=True)
+
+    carga = sub.add_parser('carga', help='simular uma frota de máquinas contra o servidor')
+    carga.add_argument('--maquinas', type=int, default=20)
+    carga.add_argument('--duracao', type=int, default=30, help='segundos')
+    carga.add_argument('--taxa-validar', type=float, default=0.2, help='validações/s por máquina')
+    carga.add_argument('--taxa-log', type=float, default=0.5, help='logs/s por máquina')
+    carga.add_argument('--fracao-negados', type=float, default=0.05, help='fração de UIDs desconhecidos')
+    carga.add_argument('--usuarios', type=int, default=200)
+    carga.add_argument('--dashboards', type=int, default=2)
+    carga.add_argument('--intervalo-dashboard', type=float, default=10)
+    carga.add_argument('--producao', action='store_true', help='subir o servidor com --producao')
+    carga.add_argument('--saida', help='arquivo JSON de resultado')
+    carga.set_defaults(func=teste_carga)
+
+    micro = sub.add_parser('micro', help='medir as consultas do banco com tabelas pré-populadas')
+    micro.add_argument('--linhas', default='10000,1000000', help='tamanhos da tabela logs, separados por vírgula')
+    micro.add_argument('--repeticoes', type=int, default=50)
+    micro.add_argument('--saida', help='arquivo JSON de resultado')
+    micro.set_defaults(func=microbenchmarks)
+
+    args = parser.parse_args()
+    args.func(args)
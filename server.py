@@ -9,31 +9,673 @@ Python 3 + Flask + SQLite3
 =====================================================
 """
 
-from flask import Flask, request, jsonify, render_template_string
+from flask import Flask, Response, request, jsonify, render_template_string, g, has_app_context
 from flask_cors import CORS
 import sqlite3
 import json
 from datetime import datetime
+from collections import OrderedDict, deque
+from contextlib import contextmanager, ExitStack
+from functools import wraps
+from itertools import chain, islice
+from urllib.parse import quote
+import threading
+import queue
+import atexit
+import time
+import argparse
+import gzip
+import zlib
+import hashlib
+import struct
+import asyncio
+import signal
+import bisect
+import heapq
+import random
+import logging
+import logging.handlers
+import sys
+import csv
+import io
 import os
+import codecs
+import tempfile
 
-app = Flask(__name__)
-CORS(app)
+app = Flask(__name__, static_folder=None)
+CORS(app, expose_headers=['X-Proximo-After-Id', 'X-Proximo-Before-Ts', 'X-Proximo-Before-Id',
+                          'X-Proximo-After-Nome', 'X-Allowlist-Versao'])
 
 # Configurações
 DATABASE = 'controle_acesso.db'
 PORT = 3000
+CACHE_USUARIOS_MAX = 50000  # Máximo de UIDs mantidos em memória
+DB_POOL_TAMANHO = 24        # Conexões SQLite mantidas abertas (threads HTTP + reserva)
+DB_POOL_RESERVA = 8         # Conexões além das threads HTTP (fila de logs, sessões, retenção...)
+DB_POOL_ESPERA = 10         # Segundos esperando uma conexão livre
+DB_CACHE_KB = 8192          # Cache de páginas por conexão (KiB)
+DB_MMAP_BYTES = 64 * 1024 * 1024
+DB_STATEMENTS_CACHE = 256   # Prepared statements em cache por conexão
+LOG_ESCRITA_ATRASADA = False  # True = /api/log enfileira e grava em grupo
+LOG_FILA_MAX = 10000        # Eventos aguardando gravação (back-pressure acima disso)
+LOG_GRUPO_EVENTOS = 200     # Gravar quando juntar N eventos...
+LOG_GRUPO_MS = 250          # ...ou a cada T milissegundos
+LOG_LOTE_MAX = 1000         # Máximo de eventos por POST /api/logs/batch
+LOG_CHAVES_RECENTES = 50000 # Chaves de idempotência lembradas em memória (retries do ESP32)
+LOG_CHAVE_MAX = 64          # Tamanho máximo da chave enviada pelo cliente
+LOGS_LIMITE_MAX = 5000      # Máximo de logs por página JSON (use stream para exportar)
+LOGS_STREAM_BLOCO = 500     # Linhas lidas do cursor por vez no modo stream
+SSE_BUFFER_CLIENTE = 256    # Eventos pendentes por cliente SSE antes de desconectá-lo
+SSE_HISTORICO = 1000        # Eventos recentes em memória para retomar via Last-Event-ID
+SSE_KEEPALIVE = 15          # Segundos entre comentários de keep-alive
+STREAMS_MAX = 4             # SSE e exportações em stream simultâneos (no --producao: threads // 4)
+GZIP_MINIMO = 1024          # Comprimir respostas a partir deste tamanho (bytes)
+GZIP_NIVEL = 6
+RETENCAO_DIAS = 90          # Logs mais antigos vão para o arquivo (None = desativado)
+ARQUIVO_DIR = 'arquivo_logs'  # Segmentos .ndjson.gz por mês (UTC), em timestamp decrescente
+ARQUIVO_FUSAO = 8           # Segmentos de um mesmo nível fundidos em um só (limita os abertos na leitura)
+RETENCAO_LOTE = 500         # Linhas movidas por transação
+RETENCAO_PAUSA = 0.2        # Segundos entre lotes, liberando o lock de escrita
+RETENCAO_INTERVALO = 3600   # Segundos entre varreduras
+BACKUP_INTERVALO = 6 * 3600 # Segundos entre backups online (None = desativado)
+BACKUP_DIR = 'backups'
+BACKUP_MANTER = 7           # Snapshots guardados (os mais antigos são apagados)
+BACKUP_PAGINAS = 256        # Páginas copiadas por passo da API de backup
+BACKUP_PAUSA = 0.05         # Segundos entre passos, deixando o disco para a ingestão
+BACKUP_REINICIOS_MAX = 3    # Reinícios por escrita concorrente antes de copiar o resto num passo só
+FUSO_HORARIO = -3 * 3600    # Deslocamento da fábrica em relação ao UTC (dias dos relatórios)
+ALLOWLIST_HISTORICO = 10000 # Alterações guardadas para delta-sync (mais antigo = snapshot completo)
+ALLOWLIST_BLOOM_BITS = 10   # Bits por UID no filtro de Bloom (~1% de falso positivo)
+ALLOWLIST_BLOOM_HASHES = 7
+PORTA_BINARIA = None        # Porta UDP+TCP do protocolo binário de validação (None = desativado)
+PRODUCAO_THREADS = 16       # Threads de atendimento no modo --producao
+PRODUCAO_CONEXOES = 200     # Conexões simultâneas aceitas (acima disso ficam na fila do SO)
+PRODUCAO_BACKLOG = 128      # Fila de conexões pendentes do socket
+PRODUCAO_KEEPALIVE = 120    # Segundos até fechar uma conexão keep-alive ociosa
+PRODUCAO_ENCERRAR = 10      # Segundos esperando requisições em andamento ao parar
+LOG_NIVEL = 'INFO'          # DEBUG, INFO, WARNING, ERROR
+LOG_CONSOLE = True          # Também mostrar no terminal (pela thread de logging)
+LOG_ARQUIVO = 'servidor.jsonl'  # Registros estruturados (None = sem arquivo)
+LOG_ARQUIVO_MAX_BYTES = 5 * 1024 * 1024
+LOG_ARQUIVO_BACKUPS = 3
+LOG_FILA_REGISTROS = 10000  # Registros aguardando escrita (acima disso são descartados)
+LOG_AMOSTRAGEM = {          # Fração mantida dos tipos de registro de alto volume
+    'usuario_validado': 1.0,
+    'uid_negado': 1.0,
+    'log_registrado': 1.0,
+}
+SESSAO_EVENTOS_INICIO = ('MAQUINA_LIGADA',)     # Eventos que abrem a sessão do uid na máquina
+SESSAO_EVENTOS_FIM = ('MAQUINA_DESLIGADA',)     # Eventos que fecham a sessão aberta da máquina
+SESSAO_EXPIRAR = 12 * 3600  # Sessão sem nenhum evento da máquina por este tempo é encerrada
+SESSAO_VARREDURA = 60       # Segundos entre verificações de sessões expiradas
+VALIDADE_MAX = 4102444800   # Maior validade aceita (01/01/2100 UTC)
+VALIDADE_VERIFICAR_MAX = 60 # Segundos máximos dormindo entre checagens (relógio do celular pode mudar)
+MAQUINA_OFFLINE = 90        # Segundos sem sinal até a máquina ser considerada offline
+MAQUINAS_GRAVAR_INTERVALO = 30  # Segundos entre gravações do último sinal no banco
+FIRMWARE_MAX = 64           # Tamanho máximo da versão de firmware informada pela máquina
+USUARIOS_LIMITE_MAX = 500   # Máximo de usuários por página em /api/usuarios?limite=
+IMPORTACAO_BLOCO = 500      # Linhas por executemany na importação de usuários
+IMPORTACAO_BLOCO_BYTES = 64 * 1024  # Leitura do upload para o arquivo temporário
+IMPORTACAO_ERROS_MAX = 1000 # Erros por linha detalhados na resposta
+ESTATICOS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'static')
+ESTATICOS_MAX_AGE = 365 * 24 * 3600  # Cache de CSS/JS com hash no nome (segundos)
+ADMISSAO_ATIVA = True       # Limites por máquina/IP e prioridade para validação
+ADMISSAO_CONCORRENCIA = 16  # Requisições simultâneas no app (no modo --producao, = --threads)
+ADMISSAO_FRACAO = {         # Parte da concorrência que cada classe pode ocupar; o resto fica para validação
+    'ingestao': 0.75,
+    'leitura': 0.5,
+}
+ADMISSAO_MAQUINA = (5, 20)  # Tokens por segundo e rajada por machine_id
+ADMISSAO_IP = (20, 60)      # Idem por IP (cobrado junto com o da máquina)
+ADMISSAO_BALDES_MAX = 10000 # Baldes mantidos em memória (LRU)
+METRICAS_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
+
+# ==================== LOGGING ESTRUTURADO ====================
+
+class FormatadorJSON(logging.Formatter):
+    """Uma linha JSON por registro"""
+
+    def format(self, record):
+        registro = {
+            'ts': round(record.created, 3),
+            'nivel': record.levelname,
+            'tipo': getattr(record, 'tipo', None),
+            'msg': record.getMessage(),
+        }
+        registro.update(getattr(record, 'dados', None) or {})
+        return json.dumps(registro, ensure_ascii=False, default=str)
+
+class FiltroAmostragem(logging.Filter):
+    """Descarta parte dos registros dos tipos listados em LOG_AMOSTRAGEM"""
+
+    def filter(self, record):
+        fracao = LOG_AMOSTRAGEM.get(getattr(record, 'tipo', None), 1.0)
+        return fracao >= 1.0 or random.random() < fracao
+
+class HandlerFilaSemBloqueio(logging.handlers.QueueHandler):
+    """QueueHandler que descarta (e conta) em vez de bloquear com a fila cheia"""
+
+    descartados = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            HandlerFilaSemBloqueio.descartados += 1
+
+def configurar_logging():
+    """Requisições só enfileiram; uma thread escreve no terminal e no arquivo"""
+    destinos = []
+    if LOG_CONSOLE:
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(logging.Formatter('%(message)s'))
+        destinos.append(console)
+    if LOG_ARQUIVO:
+        arquivo = logging.handlers.RotatingFileHandler(
+            LOG_ARQUIVO, maxBytes=LOG_ARQUIVO_MAX_BYTES,
+            backupCount=LOG_ARQUIVO_BACKUPS, encoding='utf-8', delay=True
+        )
+        arquivo.setFormatter(FormatadorJSON())
+        destinos.append(arquivo)
+    
+    fila = HandlerFilaSemBloqueio(queue.Queue(LOG_FILA_REGISTROS))
+    fila.addFilter(FiltroAmostragem())
+    
+    logger = logging.getLogger('controle_acesso')
+    logger.setLevel(LOG_NIVEL)
+    logger.propagate = False
+    logger.addHandler(fila)
+    
+    ouvinte = logging.handlers.QueueListener(fila.queue, *destinos, respect_handler_level=True)
+    ouvinte.start()
+    atexit.register(ouvinte.stop)  # Registrado primeiro: roda por último e escreve o que sobrou
+    return logger
+
+log = configurar_logging()
+
+def registrar(nivel, tipo, mensagem, **dados):
+    """Registro estruturado: 'mensagem' vai ao terminal, 'dados' ao JSON"""
+    log.log(nivel, mensagem, extra={'tipo': tipo, 'dados': dados})
+
+# ==================== MÉTRICAS ====================
+
+class Histograma:
+    """Histograma cumulativo no estilo Prometheus (buckets fixos)"""
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.contagens = [0] * (len(limites) + 1)  # Último = +Inf
+        self.soma = 0.0
+        self.total = 0
+
+    def observar(self, valor):
+        self.contagens[bisect.bisect_left(self.limites, valor)] += 1
+        self.soma += valor
+        self.total += 1
+
+    def acumulado(self):
+        acumulado = 0
+        for limite, contagem in zip(list(self.limites) + ['+Inf'], self.contagens):
+            acumulado += contagem
+            yield limite, acumulado
+
+class Metricas:
+    """Contadores e histogramas de requisições HTTP e do SQLite"""
+
+    def __init__(self, limites):
+        self.limites = limites
+        self.lock = threading.Lock()
+        self.requisicoes = {}   # (rota, metodo, status) → total
+        self.latencias = {}     # rota → Histograma
+        self.db = {}            # operacao → Histograma
+        self.em_andamento = 0
+        self.inicio = time.time()
+
+    def comecar(self):
+        with self.lock:
+            self.em_andamento += 1
+
+    def terminar(self):
+        with self.lock:
+            self.em_andamento -= 1
+
+    def observar_requisicao(self, rota, metodo, status, duracao):
+        with self.lock:
+            chave = (rota, metodo, status)
+            self.requisicoes[chave] = self.requisicoes.get(chave, 0) + 1
+            if rota not in self.latencias:
+                self.latencias[rota] = Histograma(self.limites)
+            self.latencias[rota].observar(duracao)
+
+    def observar_db(self, operacao, duracao):
+        with self.lock:
+            if operacao not in self.db:
+                self.db[operacao] = Histograma(self.limites)
+            self.db[operacao].observar(duracao)
+
+    def prometheus(self, extras):
+        """Formato de exposição em texto do Prometheus"""
+        linhas = []
+        with self.lock:
+            linhas.append('# TYPE scap_http_requisicoes_total counter')
+            for (rota, metodo, status), total in sorted(self.requisicoes.items()):
+                linhas.append(f'scap_http_requisicoes_total{{rota="{rota}",metodo="{metodo}",status="{status}"}} {total}')
+            
+            for nome, rotulo, histogramas in (
+                ('scap_http_latencia_segundos', 'rota', self.latencias),
+                ('scap_db_segundos', 'operacao', self.db),
+            ):
+                linhas.append(f'# TYPE {nome} histogram')
+                for chave, histograma in sorted(histogramas.items()):
+                    for limite, acumulado in histograma.acumulado():
+                        linhas.append(f'{nome}_bucket{{{rotulo}="{chave}",le="{limite}"}} {acumulado}')
+                    linhas.append(f'{nome}_sum{{{rotulo}="{chave}"}} {histograma.soma:.6f}')
+                    linhas.append(f'{nome}_count{{{rotulo}="{chave}"}} {histograma.total}')
+            
+            linhas.append('# TYPE scap_http_em_andamento gauge')
+            linhas.append(f'scap_http_em_andamento {self.em_andamento}')
+        
+        for nome, valor in sorted(extras.items()):
+            tipo = 'counter' if nome.endswith('_total') else 'gauge'
+            linhas.append(f'# TYPE scap_{nome} {tipo}')
+            linhas.append(f'scap_{nome} {valor}')
+        return '\n'.join(linhas) + '\n'
+
+    def json(self, extras):
+        """Mesmos dados em JSON, com percentis aproximados para o dashboard"""
+        def resumo(histograma):
+            return {
+                'total': histograma.total,
+                'media_ms': round(histograma.soma / histograma.total * 1000, 3) if histograma.total else None,
+                'p50_ms': percentil(histograma, 0.50),
+                'p95_ms': percentil(histograma, 0.95),
+                'p99_ms': percentil(histograma, 0.99),
+            }
+        
+        def percentil(histograma, fracao):
+            alvo = histograma.total * fracao
+            for limite, acumulado in histograma.acumulado():
+                if acumulado >= alvo and histograma.total:
+                    return limite * 1000 if limite != '+Inf' else None
+            return None
+        
+        with self.lock:
+            return {
+                'uptime_s': round(time.time() - self.inicio),
+                'em_andamento': self.em_andamento,
+                'requisicoes': [
+                    {'rota': r, 'metodo': m, 'status': st, 'total': t}
+                    for (r, m, st), t in sorted(self.requisicoes.items())
+                ],
+                'latencia': {rota: resumo(h) for rota, h in self.latencias.items()},
+                'db': {op: resumo(h) for op, h in self.db.items()},
+                'extras': extras
+            }
+
+metricas = Metricas(METRICAS_BUCKETS)
+
+class CursorInstrumentado(sqlite3.Cursor):
+    """Cursor que mede o tempo gasto no SQLite"""
+
+    def execute(self, *args):
+        inicio = time.perf_counter()
+        try:
+            return super().execute(*args)
+        finally:
+            metricas.observar_db('execute', time.perf_counter() - inicio)
+
+    def executemany(self, *args):
+        inicio = time.perf_counter()
+        try:
+            return super().executemany(*args)
+        finally:
+            metricas.observar_db('executemany', time.perf_counter() - inicio)
+
+class ConexaoInstrumentada(sqlite3.Connection):
+    """Conexão cujos execute/executemany/commit entram nas métricas"""
+
+    def cursor(self, factory=CursorInstrumentado):
+        return super().cursor(factory)
+
+    def execute(self, *args):
+        return self.cursor().execute(*args)
+
+    def executemany(self, *args):
+        return self.cursor().executemany(*args)
+
+    def commit(self):
+        # Em WAL com synchronous=NORMAL o fsync só ocorre nos checkpoints
+        inicio = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            metricas.observar_db('commit', time.perf_counter() - inicio)
+
+@app.before_request
+def iniciar_medicao():
+    g.inicio_requisicao = time.perf_counter()
+    metricas.comecar()
+
+@app.after_request
+def registrar_medicao(resposta):
+    inicio = g.get('inicio_requisicao')
+    if inicio is not None:
+        metricas.observar_requisicao(
+            request.endpoint or 'nao_encontrada',
+            request.method,
+            resposta.status_code,
+            time.perf_counter() - inicio
+        )
+    return resposta
+
+@app.teardown_request
+def terminar_medicao(exc):
+    if g.pop('inicio_requisicao', None) is not None:
+        metricas.terminar()
+
+# ==================== CONTROLE DE ADMISSÃO ====================
+
+# Classe de cada rota (pelo nome da função); as demais são 'leitura'
+ROTAS_VALIDACAO = {'validar_usuario'}
+ROTAS_INGESTAO = {'registrar_log', 'registrar_logs_lote', 'heartbeat', 'importar_usuarios'}
+# Monitoramento precisa responder na sobrecarga
+ROTAS_ISENTAS = {'exportar_metricas', 'estado_admissao'}
+
+class ControleAdmissao:
+    """Token buckets por máquina/IP e reserva de capacidade para validação
+
+    Validação nunca passa por balde e pode usar toda a concorrência;
+    ingestão e leituras só ocupam uma fração dela (ADMISSAO_FRACAO).
+    Acima disso a resposta é imediata (429/503 com Retry-After), em vez
+    de uma fila que atrasaria as validações. A vaga vale até o corpo da
+    resposta terminar de ser enviado (SSE e exportações em stream).
+    """
+
+    def __init__(self, capacidade):
+        self.capacidade = capacidade
+        self.baldes = OrderedDict()  # (tipo, chave) → [tokens, atualizado]
+        self.lock = threading.Lock()
+        self.em_andamento = {'validacao': 0, 'ingestao': 0, 'leitura': 0}
+        self.admitidas = {'validacao': 0, 'ingestao': 0, 'leitura': 0}
+        self.rejeitadas = {}  # (classe, motivo) → total
+
+    def _balde(self, chave, taxa, rajada, agora):
+        """Balde [tokens, atualizado] reabastecido até agora"""
+        balde = self.baldes.get(chave)
+        if balde is None:
+            balde = self.baldes[chave] = [rajada, agora]
+            while len(self.baldes) > ADMISSAO_BALDES_MAX:
+                self.baldes.popitem(last=False)
+        else:
+            self.baldes.move_to_end(chave)
+            balde[0] = min(rajada, balde[0] + (agora - balde[1]) * taxa)
+            balde[1] = agora
+        return balde
+
+    def admitir(self, classe, machine_id, ip):
+        """Retorna None (admitida) ou (status, motivo, retry_after)"""
+        agora = time.monotonic()
+        with self.lock:
+            if classe != 'validacao':
+                limite = self.capacidade * ADMISSAO_FRACAO[classe]
+                if self.em_andamento[classe] >= limite:
+                    return self._rejeitar(classe, 'sobrecarga', 503, 1)
+                
+                # Os dois baldes: trocar o machine_id informado não escapa do limite do IP
+                limites = [('ip', ip, ADMISSAO_IP)]
+                if machine_id:
+                    limites.append(('maquina', machine_id, ADMISSAO_MAQUINA))
+                baldes = []
+                espera, motivo = 0, None
+                for tipo, chave, (taxa, rajada) in limites:
+                    balde = self._balde((tipo, chave), taxa, rajada, agora)
+                    baldes.append(balde)
+                    if balde[0] < 1 and (1 - balde[0]) / taxa > espera:
+                        espera, motivo = (1 - balde[0]) / taxa, tipo
+                if motivo is not None:
+                    return self._rejeitar(classe, motivo, 429, espera)
+                for balde in baldes:
+                    balde[0] -= 1
+            elif sum(self.em_andamento.values()) >= self.capacidade:
+                return self._rejeitar(classe, 'sobrecarga', 503, 1)
+            
+            self.em_andamento[classe] += 1
+            self.admitidas[classe] += 1
+        return None
+
+    def _rejeitar(self, classe, motivo, status, espera):
+        self.rejeitadas[(classe, motivo)] = self.rejeitadas.get((classe, motivo), 0) + 1
+        return status, motivo, max(1, int(espera + 0.999))
+
+    def liberar(self, classe):
+        with self.lock:
+            self.em_andamento[classe] -= 1
+
+    def estado(self):
+        with self.lock:
+            return {
+                'ativo': ADMISSAO_ATIVA,
+                'capacidade': self.capacidade,
+                'em_andamento': dict(self.em_andamento),
+                'admitidas': dict(self.admitidas),
+                'rejeitadas': [
+                    {'classe': classe, 'motivo': motivo, 'total': total}
+                    for (classe, motivo), total in sorted(self.rejeitadas.items())
+                ],
+                'baldes': len(self.baldes)
+            }
+
+controle_admissao = ControleAdmissao(ADMISSAO_CONCORRENCIA)
+
+def classe_requisicao(endpoint):
+    if endpoint in ROTAS_VALIDACAO:
+        return 'validacao'
+    if endpoint in ROTAS_INGESTAO:
+        return 'ingestao'
+    return 'leitura'
+
+def machine_id_requisicao(endpoint):
+    """machine_id sem consumir corpos em stream (importação lê request.stream)"""
+    machine_id = request.headers.get('X-Machine-Id') or request.args.get('machine_id')
+    if not machine_id and endpoint in ('registrar_log', 'heartbeat'):
+        data = request.get_json(silent=True)
+        if isinstance(data, dict):
+            machine_id = data.get('machine_id')
+    return machine_id
+
+@app.before_request
+def admitir_requisicao():
+    endpoint = request.endpoint
+    if not ADMISSAO_ATIVA or endpoint is None or endpoint in ROTAS_ISENTAS or request.method == 'OPTIONS':
+        return None
+    
+    classe = classe_requisicao(endpoint)
+    recusa = controle_admissao.admitir(classe, machine_id_requisicao(endpoint), request.remote_addr)
+    if recusa is None:
+        g.classe_admissao = classe
+        return None
+    
+    status, motivo, espera = recusa
+    if status == 429:
+        resposta = jsonify({'erro': 'Limite de requisições excedido, tente novamente', 'motivo': motivo})
+    else:
+        resposta = jsonify({'erro': 'Servidor sobrecarregado, tente novamente', 'motivo': motivo})
+    resposta.status_code = status
+    resposta.headers['Retry-After'] = str(espera)
+    return resposta
+
+@app.after_request
+def manter_admissao(resposta):
+    """Devolver a vaga só quando o servidor fechar a resposta (streams)"""
+    classe = g.pop('classe_admissao', None)
+    if classe is not None:
+        resposta.call_on_close(lambda: controle_admissao.liberar(classe))
+    return resposta
+
+@app.teardown_request
+def liberar_admissao(exc):
+    # Exceção antes do after_request: não há resposta para carregar a vaga
+    classe = g.pop('classe_admissao', None)
+    if classe is not None:
+        controle_admissao.liberar(classe)
 
 # ==================== BANCO DE DADOS ====================
 
+class PoolConexoes:
+    """Pool limitado de conexões SQLite de longa duração (WAL)"""
+
+    def __init__(self, caminho, tamanho):
+        self.caminho = caminho
+        self.livres = queue.LifoQueue()  # LIFO: reusa a conexão com cache mais quente
+        self.tamanho = tamanho
+        self.vagas = threading.Semaphore(tamanho)
+        self.todas = []
+        self.lock = threading.Lock()
+
+    def abrir(self, avulsa=False):
+        """Abrir uma conexão já configurada com os pragmas de desempenho
+
+        avulsa=True: conexão fora do pool (ex.: exportações longas), que
+        quem abriu deve fechar.
+        """
+        db = sqlite3.connect(
+            self.caminho,
+            timeout=DB_POOL_ESPERA,
+            cached_statements=DB_STATEMENTS_CACHE,
+            check_same_thread=False,  # O pool garante uso por uma thread por vez
+            factory=ConexaoInstrumentada
+        )
+        db.row_factory = sqlite3.Row  # Retornar dict em vez de tupla
+        db.execute('PRAGMA journal_mode = WAL')
+        db.execute('PRAGMA synchronous = NORMAL')
+        db.execute(f'PRAGMA cache_size = -{DB_CACHE_KB}')
+        db.execute(f'PRAGMA mmap_size = {DB_MMAP_BYTES}')
+        db.execute('PRAGMA temp_store = MEMORY')
+        db.execute(f'PRAGMA busy_timeout = {DB_POOL_ESPERA * 1000}')
+        if not avulsa:
+            with self.lock:
+                self.todas.append(db)
+        return db
+
+    def redimensionar(self, tamanho):
+        """Aumentar o limite de conexões (ex.: --threads acima do padrão)"""
+        with self.lock:
+            for _ in range(tamanho - self.tamanho):
+                self.vagas.release()
+            self.tamanho = max(self.tamanho, tamanho)
+
+    def adquirir(self):
+        if not self.vagas.acquire(timeout=DB_POOL_ESPERA):
+            raise RuntimeError('Nenhuma conexão livre no pool do banco')
+        try:
+            return self.livres.get_nowait()
+        except queue.Empty:
+            try:
+                return self.abrir()
+            except Exception:
+                self.vagas.release()
+                raise
+
+    def devolver(self, db):
+        # Não deixar transação pendente para o próximo usuário da conexão
+        if db.in_transaction:
+            db.rollback()
+        self.livres.put(db)
+        self.vagas.release()
+
+    @contextmanager
+    def conexao(self):
+        """Conexão emprestada fora do ciclo de requisição (threads, CLI)"""
+        db = self.adquirir()
+        try:
+            yield db
+        finally:
+            self.devolver(db)
+
+    def fechar(self):
+        """Fechar todas as conexões (na saída do processo)"""
+        with self.lock:
+            conexoes, self.todas = self.todas, []
+        for db in conexoes:
+            try:
+                db.execute('PRAGMA optimize')
+            except sqlite3.Error:
+                pass
+            try:
+                db.close()
+            except sqlite3.Error:
+                pass
+
+pool = PoolConexoes(DATABASE, DB_POOL_TAMANHO)
+atexit.register(pool.fechar)
+
 def get_db():
-    """Conectar ao banco de dados"""
-    db = sqlite3.connect(DATABASE)
-    db.row_factory = sqlite3.Row  # Retornar dict em vez de tupla
-    return db
+    """Conexão do pool para a requisição atual (devolvida no teardown)"""
+    if 'db' not in g:
+        g.db = pool.adquirir()
+    return g.db
+
+@contextmanager
+def usar_db():
+    """get_db() dentro de uma requisição; conexão emprestada fora dela"""
+    if has_app_context():
+        yield get_db()
+    else:
+        with pool.conexao() as db:
+            yield db
+
+@app.teardown_appcontext
+def liberar_db(exc):
+    """Devolver a conexão da requisição ao pool"""
+    db = g.pop('db', None)
+    if db is not None:
+        pool.devolver(db)
 
 def init_db():
-    """Inicializar banco de dados"""
-    db = get_db()
+    """Criar/atualizar o esquema; dados de exemplo só em banco novo"""
+    novo = not os.path.exists(DATABASE)
+    with pool.conexao() as db:
+        migrar(db)
+        if novo:
+            inserir_dados_iniciais(db.cursor(), db)
+    print('✅ Banco de dados inicializado')
+
+def inserir_dados_iniciais(cursor, db):
+    """Inserir usuários e máquinas de exemplo"""
+    usuarios = [
+        ('FA089CBC', 'João Silva', 'Operador Senior'),
+        ('EBEABCA5', 'Maria Santos', 'Supervisora'),
+        ('6B423203', 'Pedro Costa', 'Técnico'),
+        ('FB32FAA5', 'Ana Oliveira', 'Operadora'),
+        ('AA5C15BC', 'Carlos Souza', 'Mecânico'),
+        ('F1B2715B', 'Lucas Ferreira', 'Auxiliar')
+    ]
+    
+    for uid, nome, cargo in usuarios:
+        try:
+            cursor.execute(
+                'INSERT OR IGNORE INTO usuarios (uid, nome, cargo, ativo) VALUES (?, ?, ?, 1)',
+                (uid, nome, cargo)
+            )
+        except:
+            pass
+    
+    # Máquina de exemplo
+    try:
+        cursor.execute(
+            'INSERT OR IGNORE INTO maquinas (machine_id, nome, local, ativa) VALUES (?, ?, ?, 1)',
+            ('DEMO-01', 'Torno Mecânico', 'Oficina A')
+        )
+    except:
+        pass
+    
+    db.commit()
+    print('✅ Dados iniciais inseridos')
+
+# ==================== MIGRAÇÕES ====================
+
+def migracao_tabelas_iniciais(db):
+    """Esquema original (IF NOT EXISTS: seguro em bancos antigos)"""
     cursor = db.cursor()
     
     # Tabela de usuários
@@ -76,197 +718,2012 @@ def init_db():
             criado_em INTEGER DEFAULT (strftime('%s', 'now'))
         )
     ''')
+
+def migracao_indice_logs_criado_em(db):
+    """listar_logs: ORDER BY criado_em DESC LIMIT ? sem varrer a tabela"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_logs_criado_em ON logs(criado_em)')
+
+def migracao_indice_logs_maquina(db):
+    """Consultas por máquina em ordem de tempo"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_logs_maquina_ts ON logs(machine_id, timestamp)')
+
+def migracao_indice_logs_uid(db):
+    """Consultas por usuário em ordem de tempo"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_logs_uid_ts ON logs(uid, timestamp)')
+
+def migracao_indice_logs_timestamp(db):
+    """Paginação por before_ts e intervalos de tempo sem filtro"""
+    db.execute('CREATE INDEX IF NOT EXISTS idx_logs_ts ON logs(timestamp)')
+
+TABELAS_CONTADAS = ('usuarios', 'maquinas', 'logs')
+
+def migracao_contadores(db):
+    """Tabela de contadores mantida por triggers na mesma transação do INSERT/DELETE"""
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS estatisticas (
+            chave TEXT PRIMARY KEY,
+            valor INTEGER NOT NULL DEFAULT 0
+        ) WITHOUT ROWID
+    ''')
+    for tabela in TABELAS_CONTADAS:
+        db.execute(
+            f'INSERT OR REPLACE INTO estatisticas (chave, valor) VALUES (?, (SELECT COUNT(*) FROM {tabela}))',
+            (tabela,)
+        )
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{tabela}_contar_insert AFTER INSERT ON {tabela}
+            BEGIN
+                UPDATE estatisticas SET valor = valor + 1 WHERE chave = '{tabela}';
+            END
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_{tabela}_contar_delete AFTER DELETE ON {tabela}
+            BEGIN
+                UPDATE estatisticas SET valor = valor - 1 WHERE chave = '{tabela}';
+            END
+        ''')
+
+def migracao_rollups_uso(db):
+    """Somas de logs.duracao (segundos) por hora/dia, máquina e usuário
+
+    Mantidas por trigger no INSERT de logs; a retenção apaga logs
+    antigos mas não mexe nos rollups.
+    """
+    # Início do dia local, expresso em timestamp UTC
+    dia = f'((NEW.timestamp + {FUSO_HORARIO}) / 86400) * 86400 - {FUSO_HORARIO}'
+    periodos = {
+        'uso_horario': ('hora', '(NEW.timestamp / 3600) * 3600'),
+        'uso_diario': ('dia', dia),
+    }
+    for tabela, (coluna, expressao) in periodos.items():
+        db.execute(f'''
+            CREATE TABLE IF NOT EXISTS {tabela} (
+                {coluna} INTEGER NOT NULL,
+                machine_id TEXT NOT NULL,
+                uid TEXT NOT NULL,
+                segundos INTEGER NOT NULL DEFAULT 0,
+                eventos INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY ({coluna}, machine_id, uid)
+            ) WITHOUT ROWID
+        ''')
+        db.execute(f'''
+            INSERT OR REPLACE INTO {tabela} ({coluna}, machine_id, uid, segundos, eventos)
+            SELECT {expressao.replace('NEW.', '')} AS periodo, machine_id, uid, SUM(duracao), COUNT(*)
+            FROM logs WHERE duracao > 0
+            GROUP BY periodo, machine_id, uid
+        ''')
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_logs_{tabela} AFTER INSERT ON logs
+            WHEN NEW.duracao > 0
+            BEGIN
+                INSERT INTO {tabela} ({coluna}, machine_id, uid, segundos, eventos)
+                VALUES ({expressao}, NEW.machine_id, NEW.uid, NEW.duracao, 1)
+                ON CONFLICT ({coluna}, machine_id, uid) DO UPDATE SET
+                    segundos = segundos + excluded.segundos,
+                    eventos = eventos + 1;
+            END
+        ''')
+
+def migracao_allowlist(db):
+    """Registro versionado de UIDs que entram/saem do conjunto de ativos
+
+    operacao: 'A' = adicionado, 'R' = removido, 'B' = marco inicial.
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS allowlist_alteracoes (
+            versao INTEGER PRIMARY KEY AUTOINCREMENT,
+            uid TEXT NOT NULL,
+            operacao TEXT NOT NULL
+        )
+    ''')
+    db.execute("INSERT INTO allowlist_alteracoes (uid, operacao) VALUES ('', 'B')")
     
-    db.commit()
-    
-    # Inserir dados iniciais
-    inserir_dados_iniciais(cursor, db)
+    gatilhos = {
+        'insert': ('AFTER INSERT ON usuarios WHEN NEW.ativo = 1',
+                   "VALUES (NEW.uid, 'A')"),
+        'delete': ('AFTER DELETE ON usuarios WHEN OLD.ativo = 1',
+                   "VALUES (OLD.uid, 'R')"),
+        'update_sai': ('AFTER UPDATE OF ativo, uid ON usuarios '
+                       'WHEN OLD.ativo = 1 AND (NEW.ativo IS NOT 1 OR NEW.uid != OLD.uid)',
+                       "VALUES (OLD.uid, 'R')"),
+        'update_entra': ('AFTER UPDATE OF ativo, uid ON usuarios '
+                         'WHEN NEW.ativo = 1 AND (OLD.ativo IS NOT 1 OR NEW.uid != OLD.uid)',
+                         "VALUES (NEW.uid, 'A')"),
+    }
+    for nome, (quando, valores) in gatilhos.items():
+        db.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS trg_allowlist_{nome} {quando}
+            BEGIN
+                INSERT INTO allowlist_alteracoes (uid, operacao) {valores};
+            END
+        ''')
+
+def migracao_heartbeat_maquinas(db):
+    """Último sinal de cada máquina (gravado em lote por RegistroMaquinas)"""
+    db.execute('ALTER TABLE maquinas ADD COLUMN visto_em INTEGER')
+    db.execute('ALTER TABLE maquinas ADD COLUMN rssi INTEGER')
+    db.execute('ALTER TABLE maquinas ADD COLUMN firmware TEXT')
+
+def migracao_sessoes(db):
+    """Sessões de uso pareadas a partir dos eventos de início/fim
+
+    encerramento: 'fim' (evento de fim), 'substituida' (outro uid ligou a
+    máquina) ou 'expirada' (sem eventos por SESSAO_EXPIRAR segundos).
+    """
+    db.execute('''
+        CREATE TABLE IF NOT EXISTS sessoes (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            machine_id TEXT NOT NULL,
+            uid TEXT NOT NULL,
+            usuario TEXT,
+            inicio INTEGER NOT NULL,
+            ultimo_evento INTEGER NOT NULL,
+            fim INTEGER,
+            duracao INTEGER,
+            encerramento TEXT
+        )
+    ''')
+    # No máximo uma sessão aberta por máquina
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_sessoes_abertas ON sessoes(machine_id) WHERE fim IS NULL')
+    db.execute('CREATE INDEX IF NOT EXISTS idx_sessoes_inicio ON sessoes(inicio)')
+
+def migracao_chave_logs(db):
+    """Chave de idempotência: retries do mesmo evento não duplicam linhas
+
+    Logs antigos ficam com chave NULL, fora do índice parcial.
+    """
+    db.execute('ALTER TABLE logs ADD COLUMN chave TEXT')
+    db.execute('CREATE UNIQUE INDEX IF NOT EXISTS idx_logs_chave ON logs(chave) WHERE chave IS NOT NULL')
+
+def migracao_busca_usuarios(db):
+    """Paginação por (nome, id) e busca por trecho em nome, uid e cargo
+
+    A busca por trecho usa FTS5 com tokenizer trigram (SQLite 3.34+),
+    mantida por triggers; sem ele, consulta_usuarios cai para LIKE.
+    """
+    db.execute('CREATE INDEX IF NOT EXISTS idx_usuarios_nome ON usuarios(nome, id)')
+    try:
+        db.execute('''
+            CREATE VIRTUAL TABLE IF NOT EXISTS usuarios_busca USING fts5(
+                uid, nome, cargo, content='usuarios', content_rowid='id', tokenize='trigram'
+            )
+        ''')
+    except sqlite3.OperationalError:
+        print('⚠️ SQLite sem FTS5/trigram: busca de usuários por LIKE')
+        return
     
-    db.close()
-    print('✅ Banco de dados inicializado')
+    apagar = "INSERT INTO usuarios_busca (usuarios_busca, rowid, uid, nome, cargo) VALUES ('delete', OLD.id, OLD.uid, OLD.nome, OLD.cargo);"
+    inserir = 'INSERT INTO usuarios_busca (rowid, uid, nome, cargo) VALUES (NEW.id, NEW.uid, NEW.nome, NEW.cargo);'
+    gatilhos = {
+        'insert': ('AFTER INSERT ON usuarios', inserir),
+        'delete': ('AFTER DELETE ON usuarios', apagar),
+        'update': ('AFTER UPDATE OF uid, nome, cargo ON usuarios', apagar + inserir),
+    }
+    for nome, (quando, corpo) in gatilhos.items():
+        db.execute(f'CREATE TRIGGER IF NOT EXISTS trg_usuarios_busca_{nome} {quando} BEGIN {corpo} END')
+    db.execute("INSERT INTO usuarios_busca (usuarios_busca) VALUES ('rebuild')")
 
-def inserir_dados_iniciais(cursor, db):
-    """Inserir usuários e máquinas de exemplo"""
-    usuarios = [
-        ('FA089CBC', 'João Silva', 'Operador Senior'),
-        ('EBEABCA5', 'Maria Santos', 'Supervisora'),
-        ('6B423203', 'Pedro Costa', 'Técnico'),
-        ('FB32FAA5', 'Ana Oliveira', 'Operadora'),
-        ('AA5C15BC', 'Carlos Souza', 'Mecânico'),
-        ('F1B2715B', 'Lucas Ferreira', 'Auxiliar')
-    ]
+def migracao_remover_indice_criado_em(db):
+    """listar_logs ordena por (timestamp, id); o índice de criado_em só custava nos INSERTs"""
+    db.execute('DROP INDEX IF EXISTS idx_logs_criado_em')
+
+# Ordem importa: cada migração roda uma única vez, registrada em PRAGMA user_version
+MIGRACOES = [
+    (1, 'Tabelas iniciais', migracao_tabelas_iniciais),
+    (2, 'Índice logs(criado_em)', migracao_indice_logs_criado_em),
+    (3, 'Índice logs(machine_id, timestamp)', migracao_indice_logs_maquina),
+    (4, 'Índice logs(uid, timestamp)', migracao_indice_logs_uid),
+    (5, 'Índice logs(timestamp)', migracao_indice_logs_timestamp),
+    (6, 'Contadores incrementais', migracao_contadores),
+    (7, 'Rollups de uso por hora e por dia', migracao_rollups_uso),
+    (8, 'Histórico de alterações da allowlist', migracao_allowlist),
+    (9, 'Último sinal das máquinas', migracao_heartbeat_maquinas),
+    (10, 'Sessões de uso', migracao_sessoes),
+    (11, 'Chave de idempotência dos logs', migracao_chave_logs),
+    (12, 'Busca e paginação de usuários', migracao_busca_usuarios),
+    (13, 'Remover índice logs(criado_em)', migracao_remover_indice_criado_em),
+]
+
+def migrar(db):
+    """Aplicar, em ordem, as migrações ainda não aplicadas"""
+    versao = db.execute('PRAGMA user_version').fetchone()[0]
     
-    for uid, nome, cargo in usuarios:
+    for numero, descricao, migracao in MIGRACOES:
+        if numero <= versao:
+            continue
+        
+        inicio = time.perf_counter()
+        db.execute('BEGIN IMMEDIATE')
         try:
-            cursor.execute(
-                'INSERT OR IGNORE INTO usuarios (uid, nome, cargo, ativo) VALUES (?, ?, ?, 1)',
-                (uid, nome, cargo)
+            migracao(db)
+            db.execute(f'PRAGMA user_version = {numero}')
+            db.commit()
+        except Exception:
+            db.rollback()
+            print(f'❌ Migração {numero} ({descricao}) falhou')
+            raise
+        
+        duracao_ms = (time.perf_counter() - inicio) * 1000
+        print(f'🔧 Migração {numero} aplicada: {descricao} ({duracao_ms:.0f} ms)')
+
+# ==================== CONTADORES ====================
+
+def ler_contadores(db):
+    """Totais de usuarios, maquinas e logs em O(1)"""
+    linhas = db.execute('SELECT chave, valor FROM estatisticas').fetchall()
+    return {linha['chave']: linha['valor'] for linha in linhas}
+
+def reconciliar_contadores():
+    """Recalcular os contadores do zero; retorna a diferença corrigida"""
+    with pool.conexao() as db:
+        db.execute('BEGIN IMMEDIATE')
+        antes = ler_contadores(db)
+        diferencas = {}
+        for tabela in TABELAS_CONTADAS:
+            real = db.execute(f'SELECT COUNT(*) FROM {tabela}').fetchone()[0]
+            db.execute(
+                'INSERT OR REPLACE INTO estatisticas (chave, valor) VALUES (?, ?)',
+                (tabela, real)
             )
-        except:
-            pass
+            diferencas[tabela] = real - antes.get(tabela, 0)
+        db.commit()
+    return diferencas
+
+# ==================== CACHE DE AUTORIZAÇÃO ====================
+
+class CacheUsuarios:
+    """Mapa UID → usuário em memória, para validar sem tocar no disco"""
+
+    def __init__(self, limite):
+        self.limite = limite
+        self.dados = OrderedDict()  # Ordem LRU: mais recente no fim
+        self.lock = threading.Lock()
+        self.carregado = False
+        self.completo = False  # True = todos os ativos estão em memória
+        self.hits = 0
+        self.misses = 0
+
+    def carregar(self):
+        """(Re)carregar todos os usuários ativos a partir da tabela"""
+        with usar_db() as db:
+            linhas = db.execute(
+                'SELECT uid, nome, cargo FROM usuarios WHERE ativo = 1 LIMIT ?',
+                (self.limite + 1,)
+            ).fetchall()
+
+        with self.lock:
+            self.dados.clear()
+            for linha in linhas[:self.limite]:
+                self.dados[linha['uid']] = dict(linha)
+            self.completo = len(linhas) <= self.limite
+            self.carregado = True
+
+    def obter(self, uid):
+        """Buscar usuário ativo pelo UID; retorna dict ou None"""
+        if not self.carregado:
+            self.carregar()
+
+        with self.lock:
+            if uid in self.dados:
+                self.hits += 1
+                self.dados.move_to_end(uid)
+                return self.dados[uid]
+            if self.completo:
+                # Todos os ativos estão no cache: ausência = não autorizado
+                self.hits += 1
+                return None
+            self.misses += 1
+
+        with usar_db() as db:
+            linha = db.execute(
+                'SELECT uid, nome, cargo FROM usuarios WHERE uid = ? AND ativo = 1',
+                (uid,)
+            ).fetchone()
+
+        usuario = dict(linha) if linha else None
+        self._guardar(uid, usuario)
+        return usuario
+
+    def atualizar(self, uid, usuario):
+        """Write-through: refletir inserção/alteração de um usuário"""
+        if not self.carregado:
+            return
+        self._guardar(uid, usuario)
+
+    def remover(self, uid):
+        """Write-through: refletir remoção/desativação de um usuário"""
+        with self.lock:
+            if self.completo:
+                self.dados.pop(uid, None)
+            else:
+                # Entrada negativa evita nova consulta ao banco
+                self.dados[uid] = None
+                self.dados.move_to_end(uid)
+                self._limitar()
+
+    def _guardar(self, uid, usuario):
+        with self.lock:
+            if usuario is None and self.completo:
+                self.dados.pop(uid, None)
+                return
+            self.dados[uid] = usuario
+            self.dados.move_to_end(uid)
+            self._limitar()
+
+    def _limitar(self):
+        while len(self.dados) > self.limite:
+            self.dados.popitem(last=False)
+            self.completo = False
+
+    def estatisticas(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                'tamanho': len(self.dados),
+                'limite': self.limite,
+                'completo': self.completo,
+                'hits': self.hits,
+                'misses': self.misses,
+                'taxa_acerto': round(self.hits / total, 4) if total else None
+            }
+
+cache_usuarios = CacheUsuarios(CACHE_USUARIOS_MAX)
+
+# ==================== VALIDADE DOS CRACHÁS ====================
+
+class AgendaValidades:
+    """Min-heap (validade, uid) dos usuários ativos com validade definida
+
+    Uma thread dorme até a próxima validade e desativa os crachás
+    vencidos; a validação continua sendo só a consulta ao cache, sem
+    comparar datas a cada leitura. Entradas obsoletas (validade
+    alterada, usuário removido) viram UPDATE sem efeito.
+    """
+
+    def __init__(self):
+        self.heap = []
+        self.condicao = threading.Condition()
+        self.parando = False
+        self.thread = None
+        self.expirados = 0
+
+    def carregar(self):
+        """Remontar o heap a partir da tabela e expirar o que já venceu"""
+        with usar_db() as db:
+            linhas = db.execute(
+                'SELECT validade, uid FROM usuarios WHERE ativo = 1 AND validade IS NOT NULL'
+            ).fetchall()
+        heap = [(linha['validade'], linha['uid']) for linha in linhas]
+        heapq.heapify(heap)
+        with self.condicao:
+            self.heap = heap
+            self.condicao.notify()
+        self.expirar_vencidos()
+
+    def iniciar(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._executar, name='validades', daemon=True)
+            self.thread.start()
+
+    def parar(self):
+        with self.condicao:
+            self.parando = True
+            self.condicao.notify()
+
+    def agendar(self, uid, validade):
+        if validade is None:
+            return
+        with self.condicao:
+            heapq.heappush(self.heap, (validade, uid))
+            # Só acordar a thread se a próxima expiração mudou
+            if self.heap[0] == (validade, uid):
+                self.condicao.notify()
+
+    def _executar(self):
+        while True:
+            with self.condicao:
+                while not self.parando:
+                    agora = time.time()
+                    if self.heap and self.heap[0][0] <= agora:
+                        break
+                    espera = VALIDADE_VERIFICAR_MAX
+                    if self.heap:
+                        espera = min(espera, self.heap[0][0] - agora)
+                    self.condicao.wait(espera)
+                if self.parando:
+                    return
+            try:
+                self.expirar_vencidos()
+            except Exception as e:
+                registrar(logging.ERROR, 'validade_erro', f'❌ Erro expirando crachás: {e}', erro=str(e))
+                time.sleep(5)
+
+    def expirar_vencidos(self):
+        """Desativar os usuários cuja validade já passou"""
+        agora = int(time.time())
+        with self.condicao:
+            vencidos = []
+            while self.heap and self.heap[0][0] <= agora:
+                vencidos.append(heapq.heappop(self.heap))
+        if not vencidos:
+            return []
+        
+        expirados = []
+        try:
+            with usar_db() as db:
+                db.execute('BEGIN IMMEDIATE')
+                for inicio in range(0, len(vencidos), 500):
+                    uids = [uid for _, uid in vencidos[inicio:inicio + 500]]
+                    marcadores = ','.join('?' * len(uids))
+                    filtro = f'uid IN ({marcadores}) AND ativo = 1 AND validade <= ?'
+                    expirados += [linha['uid'] for linha in db.execute(
+                        f'SELECT uid FROM usuarios WHERE {filtro}', (*uids, agora)
+                    )]
+                    db.execute(f'UPDATE usuarios SET ativo = 0 WHERE {filtro}', (*uids, agora))
+                db.commit()
+        except Exception:
+            # Devolver ao heap para a próxima tentativa
+            with self.condicao:
+                for item in vencidos:
+                    heapq.heappush(self.heap, item)
+            raise
+        
+        if expirados:
+            # A allowlist acompanha pelos triggers de usuarios
+            versoes.incrementar('usuarios')
+            for uid in expirados:
+                cache_usuarios.remover(uid)
+            self.expirados += len(expirados)
+            registrar(logging.INFO, 'usuarios_expirados', f'⌛ Crachás expirados: {", ".join(expirados[:20])}',
+                      quantidade=len(expirados))
+        return expirados
+
+    def estado(self):
+        with self.condicao:
+            return {
+                'agendados': len(self.heap),
+                'proxima': self.heap[0][0] if self.heap else None,
+                'expirados': self.expirados
+            }
+
+agenda_validades = AgendaValidades()
+atexit.register(agenda_validades.parar)
+
+# ==================== PROTOCOLO BINÁRIO (UDP/TCP) ====================
+
+# Requisição (15 bytes): b'V', seq u16 LE, machine_id 8 bytes ASCII
+#                        (completado com zeros), UID 4 bytes big-endian
+# Resposta: b'v', seq u16 LE, status u8 (1 = autorizado, 0 = negado,
+#           255 = requisição inválida), tamanho u8, nome UTF-8 (até 32 bytes)
+BIN_REQUISICAO = struct.Struct('<cH8s4s')
+BIN_RESPOSTA = struct.Struct('<cHBB')
+BIN_NOME_MAX = 32
+
+class ServidorBinario:
+    """Validação compacta via asyncio, ao lado do Flask, usando o mesmo cache"""
+
+    def __init__(self, porta):
+        self.porta = porta
+        self.loop = None
+        self.thread = None
+        self.transportes = []   # Socket UDP e servidor TCP
+        self.conexoes = set()   # Escritores TCP abertos
+        self.requisicoes = 0
+        self.autorizados = 0
+        self.negados = 0
+        self.invalidos = 0
+
+    def iniciar(self):
+        if self.porta is None or self.thread is not None:
+            return
+        pronto = threading.Event()
+        self.thread = threading.Thread(
+            target=self._executar, args=(pronto,), name='servidor-binario', daemon=True
+        )
+        self.thread.start()
+        pronto.wait()
+
+    def parar(self):
+        if self.loop is not None and self.loop.is_running():
+            asyncio.run_coroutine_threadsafe(self._encerrar(), self.loop)
+            self.thread.join(timeout=5)
+
+    async def _encerrar(self):
+        for transporte in self.transportes:
+            transporte.close()
+        for escritor in list(self.conexoes):
+            escritor.close()  # readexactly termina e o handler sai sozinho
+        await asyncio.sleep(0.1)
+        self.loop.stop()
+
+    def _executar(self, pronto):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        servidor_binario = self
+        
+        class ProtocoloUDP(asyncio.DatagramProtocol):
+            def connection_made(self, transporte):
+                self.transporte = transporte
+            
+            def datagram_received(self, dados, endereco):
+                servidor_binario.loop.create_task(self._responder(dados, endereco))
+            
+            async def _responder(self, dados, endereco):
+                self.transporte.sendto(await servidor_binario.responder(dados), endereco)
+        
+        async def atender_tcp(leitor, escritor):
+            self.conexoes.add(escritor)
+            try:
+                while True:
+                    dados = await leitor.readexactly(BIN_REQUISICAO.size)
+                    escritor.write(await self.responder(dados))
+                    await escritor.drain()
+            except (asyncio.IncompleteReadError, ConnectionError):
+                pass
+            finally:
+                self.conexoes.discard(escritor)
+                escritor.close()
+        
+        udp, _ = self.loop.run_until_complete(self.loop.create_datagram_endpoint(
+            ProtocoloUDP, local_addr=('0.0.0.0', self.porta)
+        ))
+        tcp = self.loop.run_until_complete(asyncio.start_server(atender_tcp, '0.0.0.0', self.porta))
+        self.transportes = [udp, tcp]
+        pronto.set()
+        self.loop.run_forever()
+        self.loop.close()
+
+    async def responder(self, dados):
+        """Montar a resposta binária para uma requisição"""
+        self.requisicoes += 1
+        if len(dados) != BIN_REQUISICAO.size or dados[:1] != b'V':
+            self.invalidos += 1
+            seq = struct.unpack_from('<H', dados, 1)[0] if len(dados) >= 3 else 0
+            return BIN_RESPOSTA.pack(b'v', seq, 255, 0)
+        
+        _, seq, machine_id, uid = BIN_REQUISICAO.unpack(dados)
+        uid = uid.hex().upper()
+        
+        if cache_usuarios.completo:
+            usuario = cache_usuarios.obter(uid)
+        else:
+            # Miss pode ir ao banco: não bloquear o event loop
+            usuario = await self.loop.run_in_executor(None, cache_usuarios.obter, uid)
+        
+        if usuario is None:
+            self.negados += 1
+            return BIN_RESPOSTA.pack(b'v', seq, 0, 0)
+        
+        self.autorizados += 1
+        nome = usuario['nome'].encode('utf-8')[:BIN_NOME_MAX]
+        nome = nome.decode('utf-8', 'ignore').encode('utf-8')  # Não cortar no meio de um caractere
+        return BIN_RESPOSTA.pack(b'v', seq, 1, len(nome)) + nome
+
+    def estado(self):
+        return {
+            'porta': self.porta,
+            'ativo': self.thread is not None,
+            'requisicoes': self.requisicoes,
+            'autorizados': self.autorizados,
+            'negados': self.negados,
+            'invalidos': self.invalidos
+        }
+
+servidor_binario = ServidorBinario(PORTA_BINARIA)
+atexit.register(servidor_binario.parar)
+
+# ==================== ALLOWLIST OFFLINE ====================
+
+# Formato binário (inteiros little-endian, UIDs em bytes big-endian,
+# completados com zeros à esquerda até 'largura'):
+#   cabeçalho: b'SCAL', tipo u8, largura/hashes u8, reservado u16
+#   tipo 1 (ordenado): versao u32, n u32, n × largura bytes em ordem crescente
+#   tipo 2 (bloom):    versao u32, m_bits u32, m_bits/8 bytes
+#                      bit_i = (crc32(uid) + i × (fnv1a32(uid) | 1)) mod m_bits
+#   tipo 3 (delta):    de u32, para u32, n_add u32, n_rem u32, adicionados, removidos
+ALLOWLIST_MAGICO = b'SCAL'
+ALLOWLIST_ORDENADO, ALLOWLIST_BLOOM, ALLOWLIST_DELTA = 1, 2, 3
+
+def uid_bytes(uid):
+    """UID hexadecimal → bytes; None se não for hexadecimal"""
+    try:
+        return bytes.fromhex(uid if len(uid) % 2 == 0 else '0' + uid)
+    except ValueError:
+        return None
+
+def fnv1a32(dados):
+    h = 0x811c9dc5
+    for b in dados:
+        h = ((h ^ b) * 0x01000193) & 0xffffffff
+    return h
+
+def largura_uids(uids):
+    return max([4] + [len(u) for u in uids])
+
+def empacotar_uids(uids, largura):
+    return b''.join(sorted(u.rjust(largura, b'\0') for u in uids))
+
+class Allowlist:
+    """Snapshots compactos dos UIDs ativos e deltas por versão"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.snapshots = {}  # (tipo, versao) → bytes; só a versão atual fica
+        self.ultima_compactacao = 0
+
+    def versao(self, db):
+        return db.execute('SELECT COALESCE(MAX(versao), 0) FROM allowlist_alteracoes').fetchone()[0]
+
+    def uids_ativos(self, db):
+        linhas = db.execute('SELECT uid FROM usuarios WHERE ativo = 1').fetchall()
+        return [b for b in (uid_bytes(l['uid']) for l in linhas) if b is not None]
+
+    def snapshot(self, db, tipo):
+        """Snapshot binário da versão atual (montado uma vez por versão)"""
+        versao = self.versao(db)
+        chave = (tipo, versao)
+        with self.lock:
+            if chave in self.snapshots:
+                return versao, self.snapshots[chave]
+        
+        uids = self.uids_ativos(db)
+        if tipo == ALLOWLIST_BLOOM:
+            dados = self._bloom(uids, versao)
+        else:
+            largura = largura_uids(uids)
+            dados = (ALLOWLIST_MAGICO + struct.pack('<BBHII', ALLOWLIST_ORDENADO, largura, 0, versao, len(uids))
+                     + empacotar_uids(uids, largura))
+        
+        with self.lock:
+            self.snapshots = {k: v for k, v in self.snapshots.items() if k[1] == versao}
+            self.snapshots[chave] = dados
+        return versao, dados
+
+    def _bloom(self, uids, versao):
+        m = max(64, len(uids) * ALLOWLIST_BLOOM_BITS)
+        m = (m + 7) // 8 * 8
+        bits = bytearray(m // 8)
+        for uid in uids:
+            h1 = zlib.crc32(uid)
+            h2 = fnv1a32(uid) | 1
+            for i in range(ALLOWLIST_BLOOM_HASHES):
+                bit = (h1 + i * h2) % m
+                bits[bit // 8] |= 1 << (bit % 8)
+        return (ALLOWLIST_MAGICO + struct.pack('<BBHII', ALLOWLIST_BLOOM, ALLOWLIST_BLOOM_HASHES, 0, versao, m)
+                + bytes(bits))
+
+    def delta(self, db, desde):
+        """(versao, adicionados, removidos) desde a versão do cliente;
+        None se o histórico já não cobre essa versão ou se ela é mais nova
+        que a do servidor (backup restaurado, banco recriado)"""
+        primeira, ultima = db.execute('SELECT MIN(versao), MAX(versao) FROM allowlist_alteracoes').fetchone()
+        if primeira is None or desde < primeira or desde > ultima:
+            return None
+        
+        estado = {}
+        versao = desde
+        for linha in db.execute(
+            'SELECT versao, uid, operacao FROM allowlist_alteracoes WHERE versao > ? ORDER BY versao',
+            (desde,)
+        ):
+            versao = linha['versao']
+            if linha['operacao'] in ('A', 'R'):
+                estado[linha['uid']] = linha['operacao']  # Vale a última operação
+        
+        adicionados = sorted(uid for uid, op in estado.items() if op == 'A')
+        removidos = sorted(uid for uid, op in estado.items() if op == 'R')
+        return versao, adicionados, removidos
+
+    def compactar(self, db):
+        """Descartar alterações além de ALLOWLIST_HISTORICO (no máximo 1×/hora)"""
+        if time.time() - self.ultima_compactacao < 3600:
+            return
+        self.ultima_compactacao = time.time()
+        versao = self.versao(db)
+        db.execute(
+            'DELETE FROM allowlist_alteracoes WHERE versao <= ?',
+            (versao - ALLOWLIST_HISTORICO,)
+        )
+        db.commit()
+
+allowlist = Allowlist()
+
+# ==================== VERSÕES / ETAG ====================
+
+class VersoesRecursos:
+    """Contador de versão por recurso, incrementado a cada escrita"""
+
+    def __init__(self):
+        # Distingue reinícios do processo (os contadores recomeçam do zero)
+        self.geracao = format(int(time.time() * 1000), 'x')
+        self.versoes = {}
+        self.lock = threading.Lock()
+
+    def incrementar(self, recurso):
+        with self.lock:
+            self.versoes[recurso] = self.versoes.get(recurso, 0) + 1
+
+    def etag(self, recurso, variante=''):
+        """ETag da versão atual; variante distingue query strings diferentes"""
+        versao = self.versoes.get(recurso, 0)
+        return f'{recurso}-{self.geracao}-{versao}-{zlib.crc32(variante.encode()):08x}'
+
+versoes = VersoesRecursos()
+
+def condicional(recurso):
+    """GET com ETag: If-None-Match igual responde 304 sem consultar o banco"""
+    def decorador(funcao):
+        @wraps(funcao)
+        def envolver(*args, **kwargs):
+            if request.method != 'GET':
+                return funcao(*args, **kwargs)
+            
+            # Lida antes do handler: uma escrita durante a consulta só gera
+            # um ETag mais antigo, e o cliente buscará de novo
+            etag = versoes.etag(recurso, request.query_string.decode())
+            if request.if_none_match.contains_weak(etag):
+                resposta = Response(status=304)
+                resposta.set_etag(etag, weak=True)
+                return resposta
+            
+            resposta = app.make_response(funcao(*args, **kwargs))
+            if resposta.status_code == 200:
+                resposta.set_etag(etag, weak=True)
+                resposta.headers['Cache-Control'] = 'no-cache'
+            return resposta
+        return envolver
+    return decorador
+
+@app.after_request
+def comprimir_resposta(resposta):
+    """gzip para respostas de texto grandes quando o cliente aceita"""
+    if (resposta.status_code != 200
+            or resposta.direct_passthrough
+            or resposta.is_streamed
+            or 'Content-Encoding' in resposta.headers):
+        return resposta
     
-    # Máquina de exemplo
+    mimetype = resposta.mimetype or ''
+    if not (mimetype.startswith('text/') or mimetype in ('application/json', 'application/javascript')):
+        return resposta
+    
+    resposta.vary.add('Accept-Encoding')
+    if 'gzip' not in request.accept_encodings:
+        return resposta
+    
+    dados = resposta.get_data()
+    if len(dados) < GZIP_MINIMO:
+        return resposta
+    
+    resposta.set_data(gzip.compress(dados, compresslevel=GZIP_NIVEL))
+    resposta.headers['Content-Encoding'] = 'gzip'
+    return resposta
+
+# ==================== PÁGINAS ESTÁTICAS ====================
+
+TIPOS_ESTATICOS = {
+    '.html': 'text/html; charset=utf-8',
+    '.css': 'text/css; charset=utf-8',
+    '.js': 'application/javascript; charset=utf-8',
+}
+
+class ArquivoEstatico:
+    """Conteúdo pronto para servir: original, gzip e hash"""
+    __slots__ = ('dados', 'gzip', 'hash', 'tipo', 'imutavel')
+
+    def __init__(self, dados, tipo, imutavel):
+        self.dados = dados
+        comprimido = gzip.compress(dados, compresslevel=9, mtime=0)
+        self.gzip = comprimido if len(comprimido) < len(dados) else None
+        self.hash = hashlib.sha256(dados).hexdigest()[:12]
+        self.tipo = tipo
+        self.imutavel = imutavel
+
+class PaginasEstaticas:
+    """Páginas, CSS e JS lidos e comprimidos uma vez na inicialização
+
+    CSS/JS ganham URL com o hash do conteúdo (dashboard.<hash>.css) e
+    cache de um ano; o HTML é reescrito para apontar para elas e é
+    revalidado por ETag, custando um 304 depois da primeira visita.
+    """
+
+    def __init__(self, diretorio):
+        self.diretorio = diretorio
+        self.arquivos = {}
+
+    def carregar(self):
+        arquivos = {}
+        urls = {}
+        # HTML por último: precisa das URLs com hash dos assets
+        nomes = sorted(os.listdir(self.diretorio), key=lambda nome: (nome.endswith('.html'), nome))
+        for nome in nomes:
+            raiz, extensao = os.path.splitext(nome)
+            tipo = TIPOS_ESTATICOS.get(extensao)
+            if tipo is None:
+                continue
+            with open(os.path.join(self.diretorio, nome), 'rb') as f:
+                dados = f.read()
+            
+            if extensao == '.html':
+                for original, url in urls.items():
+                    dados = dados.replace(original, url)
+                arquivos[nome] = ArquivoEstatico(dados, tipo, imutavel=False)
+                continue
+            
+            arquivo = ArquivoEstatico(dados, tipo, imutavel=True)
+            versionado = f'{raiz}.{arquivo.hash}{extensao}'
+            urls[f'"/static/{nome}"'.encode()] = f'"/static/{versionado}"'.encode()
+            arquivos[versionado] = arquivo
+            # Sem hash continua acessível, mas sem cache longo
+            arquivos[nome] = ArquivoEstatico(dados, tipo, imutavel=False)
+        
+        self.arquivos = arquivos  # Troca atômica: requisições em curso veem o conjunto anterior
+        return len(arquivos)
+
+    def servir(self, nome):
+        if not self.arquivos:
+            self.carregar()
+        arquivo = self.arquivos.get(nome)
+        if arquivo is None:
+            return jsonify({'erro': 'Arquivo não encontrado'}), 404
+        
+        if request.if_none_match.contains_weak(arquivo.hash):
+            resposta = Response(status=304)
+        elif arquivo.gzip is not None and 'gzip' in request.accept_encodings:
+            resposta = Response(arquivo.gzip, content_type=arquivo.tipo)
+            resposta.headers['Content-Encoding'] = 'gzip'
+        else:
+            resposta = Response(arquivo.dados, content_type=arquivo.tipo)
+        
+        resposta.set_etag(arquivo.hash, weak=True)
+        resposta.vary.add('Accept-Encoding')
+        if arquivo.imutavel:
+            resposta.headers['Cache-Control'] = f'public, max-age={ESTATICOS_MAX_AGE}, immutable'
+        else:
+            resposta.headers['Cache-Control'] = 'no-cache'
+        return resposta
+
+paginas = PaginasEstaticas(ESTATICOS_DIR)
+
+# ==================== PUSH DE EVENTOS (SSE) ====================
+
+class ClienteSSE:
+    """Assinante do hub: fila limitada própria"""
+
+    def __init__(self, tamanho):
+        self.fila = queue.Queue(maxsize=tamanho)
+        self.descartado = False  # Ficou para trás; deve reconectar e retomar
+
+class HubEventos:
+    """Broadcast em processo dos logs aceitos para os clientes SSE"""
+
+    def __init__(self, buffer_cliente, historico):
+        self.buffer_cliente = buffer_cliente
+        self.historico = deque(maxlen=historico)
+        self.clientes = set()
+        self.lock = threading.Lock()
+        self.publicados = 0
+        self.descartados = 0
+
+    def assinar(self):
+        cliente = ClienteSSE(self.buffer_cliente)
+        with self.lock:
+            self.clientes.add(cliente)
+        return cliente
+
+    def cancelar(self, cliente):
+        with self.lock:
+            self.clientes.discard(cliente)
+
+    def publicar(self, eventos):
+        with self.lock:
+            self.historico.extend(eventos)
+            self.publicados += len(eventos)
+            for cliente in list(self.clientes):
+                try:
+                    for evento in eventos:
+                        cliente.fila.put_nowait(evento)
+                except queue.Full:
+                    # Cliente lento não segura os demais: desconecta e ele retoma pelo id
+                    cliente.descartado = True
+                    self.clientes.discard(cliente)
+                    self.descartados += 1
+
+    def encerrar(self):
+        """Terminar todos os streams (desligamento do servidor)"""
+        with self.lock:
+            clientes, self.clientes = self.clientes, set()
+        for cliente in clientes:
+            cliente.descartado = True
+            try:
+                cliente.fila.put_nowait(None)  # Acordar o gerador bloqueado
+            except queue.Full:
+                pass
+
+    def desde(self, ultimo_id):
+        """Eventos com id > ultimo_id, ou None se o histórico não cobre o intervalo"""
+        with self.lock:
+            if self.historico and self.historico[0]['id'] <= ultimo_id + 1:
+                return [e for e in self.historico if e['id'] > ultimo_id]
+        return None
+
+hub_eventos = HubEventos(SSE_BUFFER_CLIENTE, SSE_HISTORICO)
+
+class LimiteStreams:
+    """Teto de respostas longas (SSE e exportações em stream)
+
+    Cada uma prende uma thread de atendimento até o fim do corpo; sem
+    teto, alguns painéis abertos esgotam as threads e a validação para.
+    """
+
+    def __init__(self, limite):
+        self.limite = limite
+        self.ativos = 0
+        self.recusados = 0
+        self.lock = threading.Lock()
+
+    def ocupar(self):
+        with self.lock:
+            if self.ativos >= self.limite:
+                self.recusados += 1
+                return False
+            self.ativos += 1
+            return True
+
+    def liberar(self):
+        with self.lock:
+            self.ativos -= 1
+
+limite_streams = LimiteStreams(STREAMS_MAX)
+
+def resposta_stream(gerar, **kwargs):
+    """Response em stream que ocupa uma vaga até o servidor fechá-la
+
+    gerar() só é chamado com vaga garantida (ex.: assinar o hub SSE).
+    """
+    if not limite_streams.ocupar():
+        resposta = jsonify({'erro': 'Muitas conexões em stream abertas, tente novamente'})
+        resposta.status_code = 503
+        resposta.headers['Retry-After'] = str(SSE_KEEPALIVE)
+        return resposta
     try:
-        cursor.execute(
-            'INSERT OR IGNORE INTO maquinas (machine_id, nome, local, ativa) VALUES (?, ?, ?, 1)',
-            ('DEMO-01', 'Torno Mecânico', 'Oficina A')
+        resposta = Response(gerar(), **kwargs)
+    except Exception:
+        limite_streams.liberar()
+        raise
+    resposta.call_on_close(limite_streams.liberar)
+    return resposta
+
+# ==================== GRAVAÇÃO DE LOGS ====================
+
+SQL_INSERIR_LOG = '''INSERT INTO logs (timestamp, machine_id, uid, usuario, evento, rssi, duracao, chave)
+                     VALUES (?, ?, ?, ?, ?, ?, ?, ?)'''
+COLUNAS_LOG = ('timestamp', 'machine_id', 'uid', 'usuario', 'evento', 'rssi', 'duracao', 'chave')
+
+class ChavesRecentes:
+    """LRU chave de idempotência → id do log, para responder retries sem disco"""
+
+    def __init__(self, limite):
+        self.limite = limite
+        self.dados = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.duplicados_banco = 0
+
+    def obter(self, chave):
+        with self.lock:
+            log_id = self.dados.get(chave)
+            if log_id is not None:
+                self.dados.move_to_end(chave)
+                self.hits += 1
+            return log_id
+
+    def guardar(self, pares):
+        with self.lock:
+            for chave, log_id in pares:
+                self.dados[chave] = log_id
+                self.dados.move_to_end(chave)
+            while len(self.dados) > self.limite:
+                self.dados.popitem(last=False)
+
+    def estado(self):
+        return {
+            'tamanho': len(self.dados),
+            'limite': self.limite,
+            'duplicados_memoria': self.hits,
+            'duplicados_banco': self.duplicados_banco
+        }
+
+chaves_recentes = ChavesRecentes(LOG_CHAVES_RECENTES)
+
+def chave_log(machine_id, uid, timestamp, evento):
+    """Chave derivada do próprio evento, quando o cliente não manda uma"""
+    texto = '\x1f'.join(str(campo) for campo in (machine_id, uid, timestamp, evento))
+    return hashlib.blake2b(texto.encode(), digest_size=12).hexdigest()
+
+def campo_inteiro(data, campo, padrao):
+    """Inteiro do evento; ausente usa o padrão, null ou inválido é erro da linha"""
+    if campo not in data:
+        return padrao
+    valor = data[campo]
+    if isinstance(valor, bool) or not isinstance(valor, (int, float, str)):
+        raise ValueError(f'Campo {campo} deve ser um número inteiro')
+    try:
+        numero = int(valor)
+    except (ValueError, OverflowError):
+        raise ValueError(f'Campo {campo} deve ser um número inteiro')
+    # INTEGER do SQLite é de 64 bits; fora disso o executemany estoura
+    if not -2**63 <= numero < 2**63:
+        raise ValueError(f'Campo {campo} fora do intervalo de 64 bits')
+    return numero
+
+def normalizar_log(data, chave=None):
+    """Converter o JSON de um evento na tupla de colunas de 'logs'
+
+    A chave de idempotência vem do campo 'chave' (ou do header
+    Idempotency-Key); sem ela, é derivada de (machine_id, uid,
+    timestamp, evento) quando o ESP32 informa o timestamp.
+    """
+    if not isinstance(data, dict):
+        raise ValueError('Evento deve ser um objeto JSON')
+    for campo in ('machine_id', 'uid', 'evento'):
+        if not data.get(campo):
+            raise ValueError(f'Campo obrigatório ausente: {campo}')
+    for campo in ('machine_id', 'uid', 'usuario', 'evento'):
+        if isinstance(data.get(campo), (dict, list)):
+            raise ValueError(f'Campo {campo} deve ser texto')
+    
+    timestamp = campo_inteiro(data, 'timestamp', None)
+    
+    chave = data.get('chave') or chave
+    if chave is not None:
+        chave = str(chave)
+        if len(chave) > LOG_CHAVE_MAX:
+            raise ValueError(f'Chave de idempotência maior que {LOG_CHAVE_MAX} caracteres')
+    elif timestamp is not None:
+        chave = chave_log(data['machine_id'], data['uid'], timestamp, data['evento'])
+    
+    return (
+        timestamp if timestamp is not None else int(datetime.now().timestamp()),
+        data.get('machine_id'),
+        data.get('uid'),
+        data.get('usuario'),
+        data.get('evento'),
+        campo_inteiro(data, 'rssi', 0),
+        campo_inteiro(data, 'duracao', 0),
+        chave
+    )
+
+def gravar_logs(db, linhas):
+    """Inserir eventos em uma única transação; retorna (ids, novos)
+
+    ids segue a ordem de 'linhas'. Repetições de uma chave de
+    idempotência (na memória, no banco ou no próprio lote) recebem o id
+    do log original e não são gravadas de novo.
+    """
+    ids = [None] * len(linhas)
+    novas = []       # índices a inserir
+    pendentes = {}   # chave fora da memória -> índices com essa chave
+    for indice, linha in enumerate(linhas):
+        chave = linha[-1]
+        if chave is None:
+            novas.append(indice)
+            continue
+        log_id = chaves_recentes.obter(chave)
+        if log_id is not None:
+            ids[indice] = log_id
+        else:
+            pendentes.setdefault(chave, []).append(indice)
+    if not novas and not pendentes:
+        return ids, 0
+    
+    # Lock de escrita desde já: entre a conferência e o INSERT ninguém
+    # grava a mesma chave, e os ids continuam consecutivos
+    if not db.in_transaction:
+        db.execute('BEGIN IMMEDIATE')
+    
+    # Chaves que saíram da memória (reinício, LRU cheio): conferir no índice único
+    chaves = list(pendentes)
+    existentes = []
+    for inicio in range(0, len(chaves), 500):
+        bloco = chaves[inicio:inicio + 500]
+        existentes += db.execute(
+            f'SELECT chave, id FROM logs WHERE chave IN ({",".join("?" * len(bloco))})', bloco
+        ).fetchall()
+    for chave, log_id in existentes:
+        for indice in pendentes.pop(chave):
+            ids[indice] = log_id
+    chaves_recentes.guardar(existentes)
+    chaves_recentes.duplicados_banco += len(existentes)
+    
+    novas += [indices[0] for indices in pendentes.values()]
+    novas.sort()
+    inserir = [linhas[indice] for indice in novas]
+    if not inserir:
+        db.rollback()
+        return ids, 0
+    
+    db.executemany(SQL_INSERIR_LOG, inserir)
+    # Dentro da transação ninguém mais escreve: os ids são consecutivos
+    ultimo = db.execute('SELECT last_insert_rowid()').fetchone()[0]
+    for indice, log_id in zip(novas, range(ultimo - len(inserir) + 1, ultimo + 1)):
+        ids[indice] = log_id
+    for indices in pendentes.values():
+        for indice in indices[1:]:
+            ids[indice] = ids[indices[0]]
+    
+    # Sessões gravadas na mesma transação; a memória só muda após o commit.
+    # Publicar ainda com o lock: o SSE recebe os ids em ordem crescente
+    # (clientes descartam ids menores ou iguais ao último visto)
+    with indice_sessoes.lock:
+        alteradas = indice_sessoes.processar(db, inserir)
+        db.commit()
+        indice_sessoes.confirmar(alteradas)
+        criado_em = int(time.time())
+        hub_eventos.publicar([
+            dict(zip(COLUNAS_LOG, linha), id=ids[indice], criado_em=criado_em)
+            for indice, linha in zip(novas, inserir)
+        ])
+    
+    chaves_recentes.guardar((linhas[indice][-1], ids[indice]) for indice in novas if linhas[indice][-1] is not None)
+    versoes.incrementar('logs')
+    return ids, len(inserir)
+
+class FilaLogs:
+    """Write-behind: fila limitada drenada por uma thread que grava em grupo"""
+
+    def __init__(self, capacidade, grupo, intervalo_ms):
+        self.fila = queue.Queue(maxsize=capacidade)
+        self.grupo = grupo
+        self.intervalo = intervalo_ms / 1000
+        self.parar_evento = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()
+        self.enfileirados = 0
+        self.gravados = 0
+        self.rejeitados = 0
+        self.grupos = 0
+        self.falhas = 0
+        self.duplicados = 0
+
+    def iniciar(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._executar, name='fila-logs', daemon=True
+                )
+                self.thread.start()
+
+    def enfileirar(self, linha):
+        """Retorna False quando a fila está cheia (back-pressure)"""
+        if self.thread is None:
+            self.iniciar()
+        try:
+            self.fila.put_nowait(linha)
+        except queue.Full:
+            self.rejeitados += 1
+            return False
+        self.enfileirados += 1
+        return True
+
+    def _coletar(self):
+        """Juntar até N eventos ou até o prazo de T ms vencer"""
+        try:
+            linhas = [self.fila.get(timeout=self.intervalo)]
+        except queue.Empty:
+            return []
+        prazo = time.monotonic() + self.intervalo
+        while len(linhas) < self.grupo:
+            restante = prazo - time.monotonic()
+            if restante <= 0:
+                break
+            try:
+                linhas.append(self.fila.get(timeout=restante))
+            except queue.Empty:
+                break
+        return linhas
+
+    def _gravar(self, linhas):
+        for tentativa in range(3):
+            try:
+                with pool.conexao() as db:
+                    _, novos = gravar_logs(db, linhas)
+                self.gravados += novos
+                self.duplicados += len(linhas) - novos
+                self.grupos += 1
+                return
+            except (sqlite3.OperationalError, RuntimeError) as e:
+                # Banco ocupado ou pool sem conexão livre: tentar de novo
+                erro = e
+                time.sleep(0.1 * (tentativa + 1))
+            except Exception as e:
+                # Erro de dados não melhora com nova tentativa; a thread segue viva
+                erro = e
+                break
+        self.falhas += len(linhas)
+        registrar(logging.ERROR, 'fila_logs_falha',
+                  f'❌ Falha gravando {len(linhas)} logs enfileirados: {erro}',
+                  quantidade=len(linhas), erro=str(erro))
+
+    def _executar(self):
+        while not self.parar_evento.is_set():
+            linhas = self._coletar()
+            if linhas:
+                self._gravar(linhas)
+        # Encerramento: gravar tudo o que sobrou
+        while True:
+            linhas = []
+            while len(linhas) < self.grupo:
+                try:
+                    linhas.append(self.fila.get_nowait())
+                except queue.Empty:
+                    break
+            if not linhas:
+                break
+            self._gravar(linhas)
+
+    def parar(self):
+        """Esvaziar a fila e encerrar a thread (na saída do processo)"""
+        self.parar_evento.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def estado(self):
+        return {
+            'ativo': LOG_ESCRITA_ATRASADA,
+            'profundidade': self.fila.qsize(),
+            'capacidade': self.fila.maxsize,
+            'enfileirados': self.enfileirados,
+            'gravados': self.gravados,
+            'duplicados': self.duplicados,
+            'grupos': self.grupos,
+            'rejeitados': self.rejeitados,
+            'falhas': self.falhas
+        }
+
+fila_logs = FilaLogs(LOG_FILA_MAX, LOG_GRUPO_EVENTOS, LOG_GRUPO_MS)
+atexit.register(fila_logs.parar)  # Roda antes de pool.fechar (ordem LIFO)
+
+# ==================== SESSÕES ====================
+
+class IndiceSessoes:
+    """Quem está em qual máquina agora, montado evento a evento
+
+    Cada máquina tem no máximo uma sessão aberta. As abertas ficam num
+    dicionário por machine_id, espelhado na tabela sessoes; consultar
+    as ativas custa O(máquinas), sem varrer logs.
+    """
+
+    def __init__(self, expirar):
+        self.expirar = expirar
+        self.abertas = {}  # machine_id -> sessão aberta
+        self.lock = threading.Lock()
+        self.parar_evento = threading.Event()
+        self.thread = None
+        self.encerradas = {'fim': 0, 'substituida': 0, 'expirada': 0}
+
+    def carregar(self):
+        with usar_db() as db:
+            linhas = db.execute(
+                'SELECT id, machine_id, uid, usuario, inicio, ultimo_evento FROM sessoes WHERE fim IS NULL'
+            ).fetchall()
+        with self.lock:
+            self.abertas = {linha['machine_id']: dict(linha) for linha in linhas}
+
+    def iniciar(self):
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._executar, name='sessoes', daemon=True)
+            self.thread.start()
+
+    def parar(self):
+        self.parar_evento.set()
+
+    def _executar(self):
+        while not self.parar_evento.wait(SESSAO_VARREDURA):
+            try:
+                self.expirar_inativas()
+            except Exception as e:
+                registrar(logging.ERROR, 'sessoes_erro', f'❌ Erro expirando sessões: {e}', erro=str(e))
+
+    def _abrir(self, db, machine_id, uid, usuario, timestamp):
+        cursor = db.execute(
+            'INSERT INTO sessoes (machine_id, uid, usuario, inicio, ultimo_evento) VALUES (?, ?, ?, ?, ?)',
+            (machine_id, uid, usuario, timestamp, timestamp)
+        )
+        return {'id': cursor.lastrowid, 'machine_id': machine_id, 'uid': uid,
+                'usuario': usuario, 'inicio': timestamp, 'ultimo_evento': timestamp}
+
+    def _fechar(self, db, sessao, fim, motivo):
+        db.execute(
+            'UPDATE sessoes SET fim = ?, duracao = ?, ultimo_evento = ?, encerramento = ? WHERE id = ?',
+            (fim, max(0, fim - sessao['inicio']), sessao['ultimo_evento'], motivo, sessao['id'])
         )
-    except:
-        pass
-    
-    db.commit()
-    print('✅ Dados iniciais inseridos')
+        self.encerradas[motivo] += 1
 
-# ==================== ROTAS API ====================
+    def processar(self, db, linhas):
+        """Parear eventos de início/fim dentro da transação dos logs
 
-@app.route('/')
-def index():
-    """Página inicial"""
-    db = get_db()
-    
-    total_usuarios = db.execute('SELECT COUNT(*) as count FROM usuarios').fetchone()['count']
-    total_maquinas = db.execute('SELECT COUNT(*) as count FROM maquinas').fetchone()['count']
-    total_logs = db.execute('SELECT COUNT(*) as count FROM logs').fetchone()['count']
-    
-    db.close()
-    
-    return f'''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Controle de Acesso - API</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <meta charset="utf-8">
-        <style>
-            body {{ 
-                font-family: Arial; 
-                max-width: 800px; 
-                margin: 50px auto; 
-                padding: 20px;
-                background: #f0f0f0;
-            }}
-            .card {{
-                background: white;
-                padding: 20px;
-                border-radius: 8px;
-                margin: 10px 0;
-                box-shadow: 0 2px 5px rgba(0,0,0,0.1);
-            }}
-            h1 {{ color: #333; }}
-            .stats {{
-                display: grid;
-                grid-template-columns: repeat(3, 1fr);
-                gap: 10px;
-                margin: 20px 0;
-            }}
-            .stat {{
-                background: #e8f4f8;
-                padding: 15px;
-                border-radius: 5px;
-                text-align: center;
-            }}
-            .stat h3 {{ margin: 0; color: #2c3e50; }}
-            .stat p {{ margin: 10px 0 0 0; font-size: 2em; color: #3498db; font-weight: bold; }}
-            .endpoint {{ 
-                background: #e8f4f8; 
-                padding: 10px; 
-                margin: 5px 0;
-                border-radius: 4px;
-                font-family: monospace;
-            }}
-            .method {{ 
-                display: inline-block;
-                padding: 2px 8px;
-                border-radius: 3px;
-                font-size: 12px;
-                font-weight: bold;
-            }}
-            .get {{ background: #61affe; color: white; }}
-            .post {{ background: #49cc90; color: white; }}
-            a {{ color: #3498db; text-decoration: none; }}
-            a:hover {{ text-decoration: underline; }}
-        </style>
-    </head>
-    <body>
-        <div class="card">
-            <h1>🔐 Sistema de Controle de Acesso</h1>
-            <p>Servidor rodando no Samsung A20</p>
-            <p><strong>Status:</strong> ✅ Online</p>
-            <p><strong>Porta:</strong> {PORT}</p>
-            <p><strong>Database:</strong> SQLite3 (Python)</p>
-        </div>
-        
-        <div class="stats">
-            <div class="stat">
-                <h3>👥 Usuários</h3>
-                <p>{total_usuarios}</p>
-            </div>
-            <div class="stat">
-                <h3>🏭 Máquinas</h3>
-                <p>{total_maquinas}</p>
-            </div>
-            <div class="stat">
-                <h3>📊 Logs</h3>
-                <p>{total_logs}</p>
-            </div>
-        </div>
-        
-        <div class="card">
-            <h2>📡 Endpoints da API</h2>
+        Chamar com self.lock; retorna as alterações (machine_id -> sessão
+        ou None) para confirmar() depois do commit.
+        """
+        alteradas = {}
+        for timestamp, machine_id, uid, usuario, evento, *_ in linhas:
+            try:
+                timestamp = int(timestamp)
+            except (TypeError, ValueError):
+                continue
+            sessao = alteradas[machine_id] if machine_id in alteradas else self.abertas.get(machine_id)
+            
+            # Evento atrasado (buffer offline do ESP32) anterior à sessão aberta
+            if sessao is not None and timestamp < sessao['inicio']:
+                continue
+            
+            if evento in SESSAO_EVENTOS_INICIO:
+                if sessao is not None and sessao['uid'] == uid:
+                    sessao = dict(sessao, ultimo_evento=max(sessao['ultimo_evento'], timestamp))
+                else:
+                    if sessao is not None:
+                        self._fechar(db, sessao, timestamp, 'substituida')
+                    sessao = self._abrir(db, machine_id, uid, usuario, timestamp)
+            elif sessao is None:
+                continue
+            elif evento in SESSAO_EVENTOS_FIM:
+                sessao = dict(sessao, ultimo_evento=max(sessao['ultimo_evento'], timestamp))
+                self._fechar(db, sessao, timestamp, 'fim')
+                sessao = None
+            else:
+                sessao = dict(sessao, ultimo_evento=max(sessao['ultimo_evento'], timestamp))
+            alteradas[machine_id] = sessao
+        return alteradas
+
+    def confirmar(self, alteradas):
+        for machine_id, sessao in alteradas.items():
+            if sessao is None:
+                self.abertas.pop(machine_id, None)
+            else:
+                self.abertas[machine_id] = sessao
+
+    def expirar_inativas(self):
+        """Encerrar sessões sem eventos há SESSAO_EXPIRAR segundos"""
+        limite = int(time.time()) - self.expirar
+        with self.lock:
+            if not any(s['ultimo_evento'] < limite for s in self.abertas.values()):
+                return 0
+        
+        with pool.conexao() as db:
+            # Mesma ordem de gravar_logs: lock de escrita do banco antes do lock do índice
+            db.execute('BEGIN IMMEDIATE')
+            with self.lock:
+                vencidas = [s for s in self.abertas.values() if s['ultimo_evento'] < limite]
+                for sessao in vencidas:
+                    self._fechar(db, sessao, sessao['ultimo_evento'], 'expirada')
+                db.commit()
+                self.confirmar({sessao['machine_id']: None for sessao in vencidas})
+        return len(vencidas)
+
+    def ativas(self, machine_id=None):
+        agora = int(time.time())
+        with self.lock:
+            if machine_id:
+                sessoes = [dict(self.abertas[machine_id])] if machine_id in self.abertas else []
+            else:
+                sessoes = [dict(s) for s in self.abertas.values()]
+        
+        sessoes.sort(key=lambda s: s['machine_id'])
+        for sessao in sessoes:
+            sessao['duracao_atual'] = max(0, agora - sessao['inicio'])
+        return {'total': len(sessoes), 'sessoes': sessoes}
+
+    def estado(self):
+        return {'abertas': len(self.abertas), 'encerradas': dict(self.encerradas)}
+
+indice_sessoes = IndiceSessoes(SESSAO_EXPIRAR)
+atexit.register(indice_sessoes.parar)
+
+# ==================== REGISTRO DE MÁQUINAS (HEARTBEAT) ====================
+
+SQL_GRAVAR_SINAL = '''INSERT INTO maquinas (machine_id, nome, ip, visto_em, rssi, firmware)
+                      VALUES (?, ?, ?, ?, ?, ?)
+                      ON CONFLICT(machine_id) DO UPDATE SET
+                          ip = excluded.ip,
+                          visto_em = excluded.visto_em,
+                          rssi = excluded.rssi,
+                          firmware = excluded.firmware'''
+
+class RegistroMaquinas:
+    """Último sinal de cada máquina em memória, gravado no banco em lote
+
+    Cada heartbeat (explícito ou implícito em /api/log e /api/validar)
+    só atualiza um dicionário; uma thread grava as máquinas alteradas
+    numa única transação a cada MAQUINAS_GRAVAR_INTERVALO segundos.
+    """
+
+    def __init__(self, intervalo):
+        self.intervalo = intervalo
+        self.maquinas = {}   # machine_id -> {'visto_em', 'ip', 'rssi', 'firmware'}
+        self.alteradas = set()
+        self.lock = threading.Lock()
+        self.parar_evento = threading.Event()
+        self.thread = None
+        self.sinais = 0
+        self.gravacoes = 0
+        self.falhas = 0
+        self.descartadas = 0
+
+    def carregar(self):
+        """Estado inicial vindo do banco (inclui máquinas nunca vistas)"""
+        with usar_db() as db:
+            linhas = db.execute('SELECT machine_id, ip, visto_em, rssi, firmware FROM maquinas').fetchall()
+        with self.lock:
+            for linha in linhas:
+                if linha['machine_id'] not in self.alteradas:
+                    self.maquinas[linha['machine_id']] = {
+                        'visto_em': linha['visto_em'],
+                        'ip': linha['ip'],
+                        'rssi': linha['rssi'],
+                        'firmware': linha['firmware']
+                    }
+
+    def iniciar(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._executar, name='registro-maquinas', daemon=True
+                )
+                self.thread.start()
+
+    def sinal(self, machine_id, ip, rssi=None, firmware=None):
+        """Registrar que a máquina está viva (O(1), sem tocar no banco)"""
+        if self.thread is None:
+            self.iniciar()
+        machine_id = str(machine_id)
+        with self.lock:
+            estado = self.maquinas.get(machine_id)
+            if estado is None:
+                estado = self.maquinas[machine_id] = {'visto_em': None, 'ip': None, 'rssi': None, 'firmware': None}
+            estado['visto_em'] = int(time.time())
+            estado['ip'] = ip
+            if rssi:
+                estado['rssi'] = rssi
+            if firmware:
+                estado['firmware'] = str(firmware)[:FIRMWARE_MAX]
+            self.alteradas.add(machine_id)
+            self.sinais += 1
+
+    def gravar(self):
+        """Gravar de uma vez todas as máquinas com sinal novo"""
+        with self.lock:
+            if not self.alteradas:
+                return 0
+            linhas = []
+            for machine_id in self.alteradas:
+                estado = self.maquinas[machine_id]
+                linhas.append((machine_id, machine_id, estado['ip'], estado['visto_em'],
+                               estado['rssi'], estado['firmware']))
+            self.alteradas = set()
+        
+        descartadas = []
+        try:
+            with pool.conexao() as db:
+                try:
+                    db.executemany(SQL_GRAVAR_SINAL, linhas)
+                except sqlite3.OperationalError:
+                    raise
+                except Exception:
+                    # Dado inválido numa linha: gravar uma a uma e descartar só as que falham
+                    db.rollback()
+                    for linha in linhas:
+                        try:
+                            db.execute(SQL_GRAVAR_SINAL, linha)
+                        except sqlite3.OperationalError:
+                            raise
+                        except Exception:
+                            descartadas.append(linha[0])
+                db.commit()
+        except Exception as e:
+            # Banco ocupado ou indisponível: devolver as pendências para o próximo ciclo
+            with self.lock:
+                self.alteradas.update(linha[0] for linha in linhas)
+            self.falhas += 1
+            registrar(logging.ERROR, 'maquinas_falha', f'❌ Falha gravando sinal de {len(linhas)} máquinas: {e}',
+                      quantidade=len(linhas), erro=str(e))
+            return 0
+        
+        if descartadas:
+            self.descartadas += len(descartadas)
+            registrar(logging.ERROR, 'maquinas_descartadas',
+                      f'❌ Sinal descartado de {len(descartadas)} máquinas (dado inválido)',
+                      maquinas=descartadas[:20])
+        versoes.incrementar('maquinas')
+        self.gravacoes += 1
+        return len(linhas) - len(descartadas)
+
+    def _executar(self):
+        while not self.parar_evento.wait(self.intervalo):
+            self.gravar()
+
+    def parar(self):
+        """Gravar o que falta e encerrar a thread (na saída do processo)"""
+        self.parar_evento.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.gravar()
+
+    def status(self):
+        """Online/offline de toda a frota, direto da memória"""
+        agora = int(time.time())
+        with self.lock:
+            itens = [(machine_id, dict(estado)) for machine_id, estado in self.maquinas.items()]
+        
+        maquinas = []
+        for machine_id, estado in sorted(itens):
+            visto_em = estado['visto_em']
+            estado['machine_id'] = machine_id
+            estado['segundos_sem_sinal'] = None if visto_em is None else agora - visto_em
+            estado['online'] = visto_em is not None and agora - visto_em <= MAQUINA_OFFLINE
+            maquinas.append(estado)
+        
+        online = sum(1 for m in maquinas if m['online'])
+        return {
+            'online': online,
+            'offline': len(maquinas) - online,
+            'limite_offline': MAQUINA_OFFLINE,
+            'maquinas': maquinas
+        }
+
+    def estado(self):
+        return {
+            'maquinas': len(self.maquinas),
+            'pendentes': len(self.alteradas),
+            'sinais': self.sinais,
+            'gravacoes': self.gravacoes,
+            'falhas': self.falhas,
+            'descartadas': self.descartadas
+        }
+
+registro_maquinas = RegistroMaquinas(MAQUINAS_GRAVAR_INTERVALO)
+atexit.register(registro_maquinas.parar)  # Roda antes de pool.fechar (ordem LIFO)
+
+# ==================== RETENÇÃO / ARQUIVO ====================
+
+def chave_arquivo(registro):
+    return registro['timestamp'], registro['id']
+
+class RetencaoLogs:
+    """Move logs fora da janela quente para arquivos mensais comprimidos
+
+    Cada lote vira um segmento já em (timestamp, id) decrescente; a
+    leitura intercala os segmentos do mês com heapq.merge, sem carregar
+    nenhum deles. A cada ARQUIVO_FUSAO segmentos de um nível, eles são
+    fundidos num segmento do nível seguinte.
+    """
+
+    def __init__(self, dias, diretorio):
+        self.dias = dias
+        self.diretorio = diretorio
+        self.parar_evento = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()  # Leitores listam/abrem enquanto a fusão troca arquivos
+        self.numero = None
+        self.arquivados = 0
+        self.ultima_execucao = None
+        self.ultima_duracao = None
+
+    def corte(self):
+        """Timestamp a partir do qual os logs ficam no banco"""
+        return int(time.time()) - self.dias * 86400
+
+    def segmentos(self):
+        """{mes: [(nivel, numero, caminho)]}; nivel None = arquivo mensal do formato antigo"""
+        meses = {}
+        if not os.path.isdir(self.diretorio):
+            return meses
+        for nome in os.listdir(self.diretorio):
+            if not (nome.startswith('logs-') and nome.endswith('.ndjson.gz')):
+                continue
+            partes = nome[5:-len('.ndjson.gz')].split('.')
+            if len(partes) == 3:
+                nivel, numero = int(partes[1]), int(partes[2])
+            elif len(partes) == 1:
+                nivel, numero = None, 0
+            else:
+                continue
+            meses.setdefault(partes[0], []).append((nivel, numero, os.path.join(self.diretorio, nome)))
+        return meses
+
+    def _gravar_segmento(self, mes, nivel, registros):
+        """Gravar registros já ordenados num arquivo temporário, com fsync
+
+        Retorna (temporario, definitivo); quem chama faz o os.replace.
+        """
+        with self.lock:
+            if self.numero is None:
+                self.numero = max((numero for lista in self.segmentos().values()
+                                   for _, numero, _ in lista), default=0)
+            self.numero += 1
+            numero = self.numero
+        caminho = os.path.join(self.diretorio, f'logs-{mes}.{nivel}.{numero:06d}.ndjson.gz')
+        temporario = caminho + '.tmp'
+        with open(temporario, 'wb') as arquivo:
+            with gzip.GzipFile(fileobj=arquivo, mode='wb') as saida:
+                for r in registros:
+                    saida.write((json.dumps(r, ensure_ascii=False) + '\n').encode('utf-8'))
+            arquivo.flush()
+            os.fsync(arquivo.fileno())
+        return temporario, caminho
+
+    @staticmethod
+    def _intercalar(arquivos):
+        """Registros de vários segmentos em (timestamp, id) decrescente, sem repetidos"""
+        anterior = None
+        for r in heapq.merge(*(map(json.loads, a) for a in arquivos), key=chave_arquivo, reverse=True):
+            # Repetidos vêm de uma queda entre gravar o segmento e apagar do banco
+            chave = chave_arquivo(r)
+            if chave != anterior:
+                anterior = chave
+                yield r
+
+    def compactar(self, mes):
+        """Fundir ARQUIVO_FUSAO segmentos de um nível num só do nível seguinte"""
+        while True:
+            por_nivel = {}
+            for segmento in self.segmentos().get(mes, []):
+                if segmento[0] is not None:
+                    por_nivel.setdefault(segmento[0], []).append(segmento)
+            cheios = [sorted(lista) for lista in por_nivel.values() if len(lista) >= ARQUIVO_FUSAO]
+            if not cheios:
+                return
+            grupo = cheios[0][:ARQUIVO_FUSAO]
+            # Só esta thread apaga segmentos: abrir sem o lock é seguro
+            with ExitStack() as pilha:
+                arquivos = [pilha.enter_context(gzip.open(c, 'rt', encoding='utf-8')) for _, _, c in grupo]
+                temporario, caminho = self._gravar_segmento(mes, grupo[0][0] + 1, self._intercalar(arquivos))
+            with self.lock:
+                os.replace(temporario, caminho)
+                for _, _, antigo in grupo:
+                    os.remove(antigo)
+
+    def converter_antigos(self):
+        """Arquivos mensais do formato antigo (em ordem de id) viram um segmento ordenado
+
+        Conversão única, na partida: só aqui o mês inteiro passa pela memória.
+        """
+        if not os.path.isdir(self.diretorio):
+            return
+        for nome in os.listdir(self.diretorio):
+            if nome.endswith('.tmp'):
+                os.remove(os.path.join(self.diretorio, nome))  # Sobra de uma queda no meio da gravação
+        for mes, lista in self.segmentos().items():
+            for nivel, _, antigo in lista:
+                if nivel is not None:
+                    continue
+                registros = {}
+                with gzip.open(antigo, 'rt', encoding='utf-8') as arquivo:
+                    for texto in arquivo:
+                        r = json.loads(texto)
+                        registros[r['id']] = r
+                ordenados = sorted(registros.values(), key=chave_arquivo, reverse=True)
+                temporario, caminho = self._gravar_segmento(mes, 0, ordenados)
+                with self.lock:
+                    os.replace(temporario, caminho)
+                    os.remove(antigo)
+                print(f'📦 Arquivo {os.path.basename(antigo)} convertido em segmento ordenado ({len(ordenados)} logs)')
+
+    def iniciar(self):
+        if self.dias is None or self.thread is not None:
+            return
+        self.converter_antigos()
+        self.thread = threading.Thread(target=self._executar, name='retencao-logs', daemon=True)
+        self.thread.start()
+
+    def parar(self):
+        self.parar_evento.set()
+
+    def _executar(self):
+        while not self.parar_evento.is_set():
+            try:
+                self.executar_passada()
+            except Exception as e:
+                registrar(logging.ERROR, 'retencao_erro', f'❌ Erro na retenção de logs: {e}', erro=str(e))
+            self.parar_evento.wait(RETENCAO_INTERVALO)
+
+    def executar_passada(self):
+        """Arquivar tudo o que saiu da janela, em lotes pequenos"""
+        inicio = time.perf_counter()
+        corte = self.corte()
+        os.makedirs(self.diretorio, exist_ok=True)
+        total = 0
+        
+        while not self.parar_evento.is_set():
+            with pool.conexao() as db:
+                linhas = db.execute(
+                    'SELECT * FROM logs WHERE timestamp < ? ORDER BY id LIMIT ?',
+                    (corte, RETENCAO_LOTE)
+                ).fetchall()
+                if not linhas:
+                    break
+                
+                # Gravar (com fsync) antes de apagar: uma queda entre os dois
+                # passos só duplica linhas no arquivo, que a leitura descarta
+                por_mes = {}
+                for linha in linhas:
+                    mes = time.strftime('%Y-%m', time.gmtime(linha['timestamp']))
+                    por_mes.setdefault(mes, []).append(dict(linha))
+                for mes, registros in por_mes.items():
+                    registros.sort(key=chave_arquivo, reverse=True)
+                    temporario, caminho = self._gravar_segmento(mes, 0, registros)
+                    with self.lock:
+                        os.replace(temporario, caminho)
+                
+                db.execute(
+                    'DELETE FROM logs WHERE id <= ? AND timestamp < ?',
+                    (linhas[-1]['id'], corte)
+                )
+                db.commit()
             
-            <div class="endpoint">
-                <span class="method get">GET</span>
-                <strong>/api/validar/&lt;uid&gt;</strong> - Validar usuário
-            </div>
+            versoes.incrementar('logs')
+            total += len(linhas)
+            self.arquivados += len(linhas)
+            for mes in por_mes:
+                self.compactar(mes)
+            time.sleep(RETENCAO_PAUSA)
+        
+        self.ultima_execucao = int(time.time())
+        self.ultima_duracao = round(time.perf_counter() - inicio, 3)
+        if total:
+            registrar(logging.INFO, 'logs_arquivados', f'📦 {total} logs arquivados em {self.ultima_duracao} s',
+                      quantidade=total, duracao_s=self.ultima_duracao)
+        return total
+
+    def consultar_arquivo(self, args):
+        """O intervalo pedido alcança logs que já saíram do banco?"""
+        if self.dias is None or args.get('after_id') is not None:
+            return False
+        desde = args.get('desde', type=int)
+        before_ts = args.get('before_ts', type=int)
+        corte = self.corte()
+        return (desde is not None and desde < corte) or (before_ts is not None and desde is None)
+
+    def ler(self, args):
+        """Logs arquivados que atendem aos filtros, em timestamp decrescente"""
+        if not os.path.isdir(self.diretorio):
+            return
+        
+        filtros = {c: args.get(c) for c in ('machine_id', 'uid', 'evento') if args.get(c)}
+        desde = args.get('desde', type=int)
+        ate = args.get('ate', type=int)
+        before_ts = args.get('before_ts', type=int)
+        before_id = args.get('before_id', type=int)
+        
+        mes_min = time.strftime('%Y-%m', time.gmtime(desde)) if desde is not None else ''
+        limite_sup = min(v for v in (ate, before_ts, self.corte()) if v is not None)
+        mes_max = time.strftime('%Y-%m', time.gmtime(limite_sup))
+        
+        for mes in sorted(self.segmentos(), reverse=True):
+            if mes > mes_max:
+                continue
+            if mes < mes_min:
+                break
             
-            <div class="endpoint">
-                <span class="method get">GET</span>
-                <strong>/api/usuarios</strong> - Listar todos usuários
-            </div>
+            with ExitStack() as pilha:
+                # Listar e abrir sob o lock: a fusão não apaga um segmento no meio
+                with self.lock:
+                    arquivos = [pilha.enter_context(gzip.open(c, 'rt', encoding='utf-8'))
+                                for _, _, c in self.segmentos().get(mes, [])]
+                for r in self._intercalar(arquivos):
+                    ts = r['timestamp']
+                    if desde is not None and ts < desde:
+                        return  # Ordem decrescente: o resto é mais antigo
+                    if ate is not None and ts > ate:
+                        continue
+                    if before_ts is not None and (
+                            ts > before_ts or (ts == before_ts and (before_id is None or r['id'] >= before_id))):
+                        continue
+                    if any(r.get(c) != v for c, v in filtros.items()):
+                        continue
+                    yield r
+
+    def estado(self):
+        return {
+            'dias': self.dias,
+            'corte': self.corte() if self.dias is not None else None,
+            'arquivados': self.arquivados,
+            'ultima_execucao': self.ultima_execucao,
+            'ultima_duracao_s': self.ultima_duracao,
+            'arquivos': sorted(os.listdir(self.diretorio)) if os.path.isdir(self.diretorio) else []
+        }
+
+retencao = RetencaoLogs(RETENCAO_DIAS, ARQUIVO_DIR)
+atexit.register(retencao.parar)
+
+# ==================== BACKUP ONLINE ====================
+
+class BackupReiniciado(Exception):
+    """A cópia em passos recomeçou vezes demais por causa de escritas"""
+
+class BackupBanco:
+    """Snapshots periódicos pela API de backup do SQLite, com o servidor no ar
+
+    A cópia anda em passos de BACKUP_PAGINAS com pausas entre eles.
+    Uma escrita de outra conexão faz o SQLite recomeçar a cópia; depois
+    de BACKUP_REINICIOS_MAX recomeços o resto vai num passo só, que no
+    modo WAL só segura um snapshot de leitura e não bloqueia quem grava.
+    """
+
+    def __init__(self, intervalo, diretorio, manter):
+        self.intervalo = intervalo
+        self.diretorio = diretorio
+        self.manter = manter
+        self.parar_evento = threading.Event()
+        self.thread = None
+        self.lock = threading.Lock()  # Um backup por vez
+        self.em_andamento = False
+        self.ultimo = None
+        self.falhas = 0
+        self.ultimo_erro = None
+
+    def arquivos(self):
+        if not os.path.isdir(self.diretorio):
+            return []
+        return sorted(nome for nome in os.listdir(self.diretorio)
+                      if nome.startswith('controle_acesso-') and nome.endswith('.db'))
+
+    def iniciar(self):
+        if self.intervalo is None or self.thread is not None:
+            return
+        self.thread = threading.Thread(target=self._executar, name='backup', daemon=True)
+        self.thread.start()
+
+    def parar(self):
+        self.parar_evento.set()
+
+    def _executar(self):
+        # Retomar o ciclo a partir do snapshot mais recente (reinícios do servidor)
+        arquivos = self.arquivos()
+        idade = time.time() - os.path.getmtime(os.path.join(self.diretorio, arquivos[-1])) if arquivos else self.intervalo
+        espera = max(60, self.intervalo - idade)
+        while not self.parar_evento.wait(espera):
+            try:
+                self.executar()
+            except Exception as e:
+                registrar(logging.ERROR, 'backup_erro', f'❌ Erro no backup: {e}', erro=str(e))
+            espera = self.intervalo
+
+    def _copiar(self, origem, caminho, paginas):
+        """Copiar origem para um arquivo novo; retorna os recomeços observados"""
+        reinicios = 0
+        restantes = None
+        
+        def progresso(status, faltam, total):
+            nonlocal reinicios, restantes
+            if restantes is not None and faltam > restantes:
+                reinicios += 1
+                if paginas > 0 and reinicios > BACKUP_REINICIOS_MAX:
+                    raise BackupReiniciado()
+            restantes = faltam
+            # O parâmetro sleep do backup() só vale para SQLITE_BUSY; a pausa entre passos é aqui
+            if faltam:
+                time.sleep(BACKUP_PAUSA)
+        
+        if os.path.exists(caminho):
+            os.remove(caminho)
+        destino = sqlite3.connect(caminho)
+        try:
+            origem.backup(destino, pages=paginas, progress=progresso)
+            # Snapshot autocontido: sem -wal ao lado do arquivo
+            destino.execute('PRAGMA journal_mode = DELETE')
+            integridade = destino.execute('PRAGMA integrity_check').fetchone()[0]
+        finally:
+            destino.close()
+        return reinicios, integridade
+
+    def executar(self):
+        """Gerar um snapshot verificado e apagar os que passaram da rotação"""
+        if not self.lock.acquire(blocking=False):
+            return None
+        self.em_andamento = True
+        try:
+            os.makedirs(self.diretorio, exist_ok=True)
+            nome = time.strftime('controle_acesso-%Y%m%d-%H%M%S.db')
+            final = os.path.join(self.diretorio, nome)
+            temporario = final + '.tmp'
+            inicio = time.perf_counter()
             
-            <div class="endpoint">
-                <span class="method post">POST</span>
-                <strong>/api/usuarios</strong> - Cadastrar usuário
-            </div>
+            origem = pool.abrir(avulsa=True)
+            try:
+                modo = 'passos'
+                try:
+                    reinicios, integridade = self._copiar(origem, temporario, BACKUP_PAGINAS)
+                except BackupReiniciado:
+                    modo = 'passo_unico'
+                    reinicios, integridade = self._copiar(origem, temporario, -1)
+                    reinicios += BACKUP_REINICIOS_MAX + 1
+                paginas = origem.execute('PRAGMA page_count').fetchone()[0]
+            finally:
+                origem.close()
             
-            <div class="endpoint">
-                <span class="method post">POST</span>
-                <strong>/api/log</strong> - Registrar log
-            </div>
+            if integridade != 'ok':
+                os.remove(temporario)
+                self.falhas += 1
+                self.ultimo_erro = f'integrity_check: {integridade}'
+                registrar(logging.ERROR, 'backup_corrompido', f'❌ Backup descartado: {integridade}',
+                          integridade=integridade)
+                return None
             
-            <div class="endpoint">
-                <span class="method get">GET</span>
-                <strong>/api/logs</strong> - Listar logs recentes
-            </div>
+            os.replace(temporario, final)
+            for antigo in self.arquivos()[:-self.manter]:
+                os.remove(os.path.join(self.diretorio, antigo))
             
-            <div class="endpoint">
-                <span class="method get">GET</span>
-                <strong>/api/maquinas</strong> - Listar máquinas
-            </div>
-        </div>
-        
-        <div class="card">
-            <h2>📊 Dashboard</h2>
-            <p><a href="/dashboard">Ver Dashboard Completo →</a></p>
-        </div>
-    </body>
-    </html>
-    '''
+            self.ultimo = {
+                'arquivo': nome,
+                'timestamp': int(time.time()),
+                'duracao_s': round(time.perf_counter() - inicio, 3),
+                'bytes': os.path.getsize(final),
+                'paginas': paginas,
+                'modo': modo,
+                'reinicios': reinicios,
+                'integridade': integridade
+            }
+            registrar(logging.INFO, 'backup_concluido',
+                      f"💾 Backup {nome}: {self.ultimo['bytes'] // 1024} KiB em {self.ultimo['duracao_s']} s",
+                      **self.ultimo)
+            return self.ultimo
+        except Exception as e:
+            self.falhas += 1
+            self.ultimo_erro = str(e)
+            raise
+        finally:
+            self.em_andamento = False
+            self.lock.release()
+
+    def estado(self):
+        return {
+            'ativo': self.intervalo is not None,
+            'intervalo': self.intervalo,
+            'diretorio': self.diretorio,
+            'manter': self.manter,
+            'em_andamento': self.em_andamento,
+            'ultimo': self.ultimo,
+            'falhas': self.falhas,
+            'ultimo_erro': self.ultimo_erro,
+            'arquivos': self.arquivos()
+        }
+
+backup = BackupBanco(BACKUP_INTERVALO, BACKUP_DIR, BACKUP_MANTER)
+atexit.register(backup.parar)
+
+# ==================== ROTAS API ====================
+
+@app.route('/')
+def index():
+    """Página inicial (estática; os totais vêm de /api/estatisticas)"""
+    return paginas.servir('index.html')
+
+@app.route('/api/estatisticas')
+def estatisticas():
+    """Totais da página inicial"""
+    contadores = ler_contadores(get_db())
+    return jsonify({
+        'usuarios': contadores.get('usuarios', 0),
+        'maquinas': contadores.get('maquinas', 0),
+        'logs': contadores.get('logs', 0),
+        'porta': PORT
+    })
 
 @app.route('/api/validar/<uid>')
 def validar_usuario(uid):
     """Validar usuário - ESP32 usa esta rota"""
     uid = uid.upper()
     
-    db = get_db()
-    usuario = db.execute(
-        'SELECT * FROM usuarios WHERE uid = ? AND ativo = 1',
-        (uid,)
-    ).fetchone()
-    db.close()
+    machine_id = request.args.get('machine_id')
+    if machine_id:
+        registro_maquinas.sinal(machine_id, request.remote_addr, firmware=request.headers.get('X-Firmware'))
+    
+    usuario = cache_usuarios.obter(uid)
     
     if usuario:
-        print(f"✅ Usuário validado: {usuario['nome']} ({uid})")
+        registrar(logging.INFO, 'usuario_validado', f"✅ Usuário validado: {usuario['nome']} ({uid})",
+                  uid=uid)
         return jsonify({
             'autorizado': True,
             'usuario': {
@@ -276,19 +2733,80 @@ def validar_usuario(uid):
             }
         })
     else:
-        print(f"❌ UID não autorizado: {uid}")
+        registrar(logging.INFO, 'uid_negado', f"❌ UID não autorizado: {uid}", uid=uid)
         return jsonify({'autorizado': False})
 
+def consulta_usuarios(db, args, limite, contar=False):
+    """Montar o SELECT de /api/usuarios: busca, filtro e cursor (nome, id)
+
+    q com 3+ caracteres busca o trecho em nome/uid/cargo pelo índice
+    trigram; mais curto (o trigram não indexa), compara o prefixo
+    percorrendo idx_usuarios_nome até completar a página.
+    """
+    condicoes = []
+    params = []
+    
+    q = (args.get('q') or '').strip()
+    if q:
+        fts = db.execute("SELECT 1 FROM sqlite_master WHERE name = 'usuarios_busca'").fetchone()
+        if len(q) >= 3 and fts:
+            condicoes.append('id IN (SELECT rowid FROM usuarios_busca WHERE usuarios_busca MATCH ?)')
+            params.append('"' + q.replace('"', '""') + '"')
+        else:
+            escapado = q.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            padrao = escapado + '%' if len(q) < 3 else '%' + escapado + '%'
+            condicoes.append("(nome LIKE ? ESCAPE '\\' OR uid LIKE ? ESCAPE '\\' OR cargo LIKE ? ESCAPE '\\')")
+            params.extend([padrao] * 3)
+    
+    ativo = args.get('ativo', type=int)
+    if ativo is not None:
+        condicoes.append('ativo = ?')
+        params.append(1 if ativo else 0)
+    
+    after_nome = args.get('after_nome')
+    after_id = args.get('after_id', type=int)
+    if after_nome is not None and not contar:
+        condicoes.append('(nome, id) > (?, ?)')
+        params.extend([after_nome, after_id or 0])
+    
+    sql = 'SELECT COUNT(*) FROM usuarios' if contar else 'SELECT * FROM usuarios'
+    if condicoes:
+        sql += ' WHERE ' + ' AND '.join(condicoes)
+    if not contar:
+        sql += ' ORDER BY nome, id'
+    if limite is not None:
+        sql += ' LIMIT ?'
+        params.append(limite)
+    
+    return sql, params
+
 @app.route('/api/usuarios', methods=['GET', 'POST'])
+@condicional('usuarios')
 def usuarios():
     """Listar ou cadastrar usuários"""
     
     if request.method == 'GET':
         db = get_db()
-        usuarios = db.execute('SELECT * FROM usuarios ORDER BY nome').fetchall()
-        db.close()
         
-        return jsonify([dict(u) for u in usuarios])
+        if request.args.get('contar') == '1':
+            if not request.args.get('q') and request.args.get('ativo') is None:
+                return jsonify({'total': ler_contadores(db).get('usuarios', 0)})
+            sql, params = consulta_usuarios(db, request.args, None, contar=True)
+            return jsonify({'total': db.execute(sql, params).fetchone()[0]})
+        
+        # Sem limite: lista completa, como antes (clientes antigos)
+        limite = request.args.get('limite', type=int)
+        if limite is not None:
+            limite = max(1, min(limite, USUARIOS_LIMITE_MAX))
+        sql, params = consulta_usuarios(db, request.args, limite)
+        usuarios = [dict(u) for u in db.execute(sql, params).fetchall()]
+        
+        resposta = jsonify(usuarios)
+        if limite is not None and len(usuarios) == limite:
+            # Nomes podem ter acentos: o header vai percent-encoded
+            resposta.headers['X-Proximo-After-Nome'] = quote(usuarios[-1]['nome'])
+            resposta.headers['X-Proximo-After-Id'] = str(usuarios[-1]['id'])
+        return resposta
     
     elif request.method == 'POST':
         data = request.get_json()
@@ -298,332 +2816,853 @@ def usuarios():
         
         if not uid or not nome:
             return jsonify({'erro': 'UID e nome são obrigatórios'}), 400
+        try:
+            validade = normalizar_validade(data.get('validade'))
+        except ValueError as e:
+            return jsonify({'erro': str(e)}), 400
         
         db = get_db()
         try:
             cursor = db.cursor()
             cursor.execute(
-                'INSERT INTO usuarios (uid, nome, cargo, ativo) VALUES (?, ?, ?, 1)',
-                (uid, nome, cargo)
+                'INSERT INTO usuarios (uid, nome, cargo, ativo, validade) VALUES (?, ?, ?, 1, ?)',
+                (uid, nome, cargo, validade)
             )
             db.commit()
             user_id = cursor.lastrowid
-            db.close()
+            versoes.incrementar('usuarios')
             
-            print(f"✅ Usuário cadastrado: {nome} ({uid})")
+            cache_usuarios.atualizar(uid, {'uid': uid, 'nome': nome, 'cargo': cargo})
+            agenda_validades.agendar(uid, validade)
+            registrar(logging.INFO, 'usuario_cadastrado', f"✅ Usuário cadastrado: {nome} ({uid})",
+                      uid=uid, id=user_id)
             return jsonify({
                 'sucesso': True,
                 'id': user_id,
                 'mensagem': 'Usuário cadastrado com sucesso'
             })
         except sqlite3.IntegrityError:
-            db.close()
             return jsonify({'erro': 'UID já cadastrado'}), 400
 
 @app.route('/api/log', methods=['POST'])
 def registrar_log():
     """Registrar log - ESP32 envia para cá"""
-    data = request.get_json()
+    data = request.get_json(silent=True)
+    
+    try:
+        linha = normalizar_log(data, request.headers.get('Idempotency-Key'))
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    
+    _, machine_id, _, usuario, evento, rssi, _, chave = linha
+    registro_maquinas.sinal(machine_id, request.remote_addr, rssi, request.headers.get('X-Firmware'))
     
-    timestamp = data.get('timestamp', int(datetime.now().timestamp()))
-    machine_id = data.get('machine_id')
-    uid = data.get('uid')
-    usuario = data.get('usuario')
-    evento = data.get('evento')
-    rssi = data.get('rssi', 0)
-    duracao = data.get('duracao', 0)
+    # Retry de um evento já gravado: responder da memória, sem tocar no disco
+    if chave is not None:
+        log_id = chaves_recentes.obter(chave)
+        if log_id is not None:
+            return jsonify({'sucesso': True, 'id': log_id, 'duplicado': True})
+    
+    if LOG_ESCRITA_ATRASADA:
+        if not fila_logs.enfileirar(linha):
+            resposta = jsonify({'erro': 'Fila de logs cheia, tente novamente'})
+            resposta.headers['Retry-After'] = '1'
+            return resposta, 503
+        return jsonify({'sucesso': True, 'enfileirado': True}), 202
     
     db = get_db()
-    cursor = db.cursor()
-    cursor.execute(
-        '''INSERT INTO logs (timestamp, machine_id, uid, usuario, evento, rssi, duracao)
-           VALUES (?, ?, ?, ?, ?, ?, ?)''',
-        (timestamp, machine_id, uid, usuario, evento, rssi, duracao)
-    )
-    db.commit()
-    log_id = cursor.lastrowid
-    db.close()
+    ids, novos = gravar_logs(db, [linha])
+    log_id = ids[0]
+    if not novos:
+        return jsonify({'sucesso': True, 'id': log_id, 'duplicado': True})
     
-    print(f"📝 Log registrado: {evento} - {usuario} ({machine_id})")
+    registrar(logging.INFO, 'log_registrado', f"📝 Log registrado: {evento} - {usuario} ({machine_id})",
+              id=log_id, machine_id=machine_id, evento=evento)
     return jsonify({'sucesso': True, 'id': log_id})
 
+@app.route('/api/logs/batch', methods=['POST'])
+def registrar_logs_lote():
+    """Registrar vários logs em uma única transação"""
+    data = request.get_json(silent=True)
+    eventos = data.get('eventos') if isinstance(data, dict) else data
+    
+    if not isinstance(eventos, list):
+        return jsonify({'erro': 'Envie uma lista de eventos'}), 400
+    if len(eventos) > LOG_LOTE_MAX:
+        return jsonify({'erro': f'Máximo de {LOG_LOTE_MAX} eventos por lote'}), 413
+    
+    linhas = []
+    erros = []
+    for indice, evento in enumerate(eventos):
+        try:
+            linhas.append(normalizar_log(evento))
+        except ValueError as e:
+            erros.append({'indice': indice, 'erro': str(e)})
+    
+    # Um sinal por máquina do lote, com o RSSI do último evento dela
+    for machine_id, rssi in {linha[1]: linha[5] for linha in linhas}.items():
+        registro_maquinas.sinal(machine_id, request.remote_addr, rssi, request.headers.get('X-Firmware'))
+    
+    db = get_db()
+    ids, novos = gravar_logs(db, linhas)
+    
+    registrar(logging.INFO, 'lote_registrado',
+              f"📝 Lote registrado: {novos} logs ({len(ids) - novos} duplicados, {len(erros)} rejeitados)",
+              inseridos=novos, duplicados=len(ids) - novos, rejeitados=len(erros))
+    return jsonify({
+        'sucesso': not erros,
+        'inseridos': novos,
+        'duplicados': len(ids) - novos,
+        'ids': ids,
+        'erros': erros
+    })
+
+def formatar_sse(evento):
+    dados = json.dumps(evento, ensure_ascii=False)
+    return f'id: {evento["id"]}\nevent: log\ndata: {dados}\n\n'
+
+def stream_sse(cliente, ultimo_id):
+    """Gerar o fluxo SSE: pendências desde Last-Event-ID e depois os novos logs"""
+    try:
+        yield 'retry: 3000\n\n'
+        
+        if ultimo_id is not None:
+            db = None
+            try:
+                while not cliente.descartado:
+                    pendentes = hub_eventos.desde(ultimo_id)
+                    coberto = pendentes is not None
+                    if not coberto:
+                        # Desconectado há muito tempo: completar a partir do banco,
+                        # em blocos, até o histórico em memória cobrir o resto
+                        if db is None:
+                            db = pool.abrir(avulsa=True)
+                        pendentes = [dict(linha) for linha in db.execute(
+                            'SELECT * FROM logs WHERE id > ? ORDER BY id LIMIT ?',
+                            (ultimo_id, LOGS_STREAM_BLOCO)
+                        )]
+                    for evento in pendentes:
+                        ultimo_id = evento['id']
+                        yield formatar_sse(evento)
+                    if coberto or not pendentes:
+                        break
+            finally:
+                if db is not None:
+                    db.close()
+        
+        while not cliente.descartado:
+            try:
+                evento = cliente.fila.get(timeout=SSE_KEEPALIVE)
+            except queue.Empty:
+                yield ': keepalive\n\n'
+                continue
+            if evento is None:
+                break
+            # O evento pode já ter sido enviado como pendência
+            if ultimo_id is not None and evento['id'] <= ultimo_id:
+                continue
+            ultimo_id = evento['id']
+            yield formatar_sse(evento)
+    finally:
+        hub_eventos.cancelar(cliente)
+
+@app.route('/api/logs/stream')
+def stream_logs_sse():
+    """Server-Sent Events com os logs novos (retoma via Last-Event-ID)"""
+    ultimo_id = request.headers.get('Last-Event-ID', type=int)
+    if ultimo_id is None:
+        ultimo_id = request.args.get('ultimo_id', type=int)
+    
+    # Assinar antes de ler as pendências para não perder eventos no meio
+    resposta = resposta_stream(lambda: stream_sse(hub_eventos.assinar(), ultimo_id),
+                               mimetype='text/event-stream')
+    resposta.headers['Cache-Control'] = 'no-cache'
+    resposta.headers['X-Accel-Buffering'] = 'no'
+    return resposta
+
+@app.route('/api/logs/fila')
+def estado_fila_logs():
+    """Profundidade e contadores da fila de gravação de logs"""
+    return jsonify(dict(fila_logs.estado(), idempotencia=chaves_recentes.estado()))
+
+def consulta_logs(args, limite):
+    """Montar o SELECT de /api/logs a partir dos filtros e do cursor
+
+    after_id: mais novos que o id, em ordem crescente. Demais casos
+    (inclusive a página padrão): timestamp decrescente, na mesma ordem
+    do cursor before_ts/before_id.
+    """
+    condicoes = []
+    params = []
+    
+    for campo in ('machine_id', 'uid', 'evento'):
+        valor = args.get(campo)
+        if valor:
+            condicoes.append(f'{campo} = ?')
+            params.append(valor)
+    
+    desde = args.get('desde', type=int)
+    ate = args.get('ate', type=int)
+    if desde is not None:
+        condicoes.append('timestamp >= ?')
+        params.append(desde)
+    if ate is not None:
+        condicoes.append('timestamp <= ?')
+        params.append(ate)
+    
+    after_id = args.get('after_id', type=int)
+    before_ts = args.get('before_ts', type=int)
+    before_id = args.get('before_id', type=int)
+    
+    if after_id is not None:
+        condicoes.append('id > ?')
+        params.append(after_id)
+        ordem = 'id ASC'
+    elif before_ts is not None:
+        if before_id is not None:
+            condicoes.append('(timestamp < ? OR (timestamp = ? AND id < ?))')
+            params.extend([before_ts, before_ts, before_id])
+        else:
+            condicoes.append('timestamp < ?')
+            params.append(before_ts)
+        ordem = 'timestamp DESC, id DESC'
+    else:
+        ordem = 'timestamp DESC, id DESC'
+    
+    sql = 'SELECT * FROM logs'
+    if condicoes:
+        sql += ' WHERE ' + ' AND '.join(condicoes)
+    sql += f' ORDER BY {ordem}'
+    if limite is not None:
+        sql += ' LIMIT ?'
+        params.append(limite)
+    
+    return sql, params
+
+def linhas_banco(sql, params):
+    """Iterar o resultado em blocos a partir de uma conexão própria"""
+    # Conexão própria: uma exportação longa não ocupa uma vaga do pool
+    db = pool.abrir(avulsa=True)
+    try:
+        cursor = db.execute(sql, params)
+        while True:
+            linhas = cursor.fetchmany(LOGS_STREAM_BLOCO)
+            if not linhas:
+                break
+            for linha in linhas:
+                yield dict(linha)
+    finally:
+        db.close()
+
+def stream_logs(linhas, formato):
+    """Gerar NDJSON ou um array JSON em blocos, com memória constante"""
+    separador = '\n' if formato == 'ndjson' else ','
+    primeiro = True
+    if formato != 'ndjson':
+        yield '['
+    while True:
+        bloco = [json.dumps(l, ensure_ascii=False) for l in islice(linhas, LOGS_STREAM_BLOCO)]
+        if not bloco:
+            break
+        texto = separador.join(bloco)
+        if formato == 'ndjson':
+            yield texto + '\n'
+        else:
+            yield texto if primeiro else ',' + texto
+        primeiro = False
+    if formato != 'ndjson':
+        yield ']'
+
 @app.route('/api/logs')
+@condicional('logs')
 def listar_logs():
-    """Listar logs recentes"""
-    limite = request.args.get('limite', 50, type=int)
+    """Listar logs com filtros, paginação por cursor e modo stream
+
+    Filtros: machine_id, uid, evento, desde, ate (timestamps).
+    Cursor: after_id, ou before_ts (+ before_id para desempate).
+    formato=ndjson ou stream=1 transmite o resultado sem carregá-lo todo.
+    Intervalos anteriores à janela de retenção continuam nos arquivos.
+    """
+    formato = request.args.get('formato', 'json')
+    stream = formato == 'ndjson' or request.args.get('stream') == '1'
+    arquivo = retencao.consultar_arquivo(request.args)
+    
+    if stream:
+        limite = request.args.get('limite', type=int)
+        if limite is not None:
+            limite = max(1, limite)
+        sql, params = consulta_logs(request.args, limite)
+        linhas = linhas_banco(sql, params)
+        if arquivo:
+            linhas = chain(linhas, retencao.ler(request.args))
+        if limite is not None:
+            linhas = islice(linhas, limite)
+        mimetype = 'application/x-ndjson' if formato == 'ndjson' else 'application/json'
+        return resposta_stream(lambda: stream_logs(linhas, formato), mimetype=mimetype)
+    
+    limite = max(1, min(request.args.get('limite', 50, type=int), LOGS_LIMITE_MAX))
+    sql, params = consulta_logs(request.args, limite)
+    
+    db = get_db()
+    logs = [dict(log) for log in db.execute(sql, params).fetchall()]
+    if arquivo and len(logs) < limite:
+        logs.extend(islice(retencao.ler(request.args), limite - len(logs)))
+    
+    resposta = jsonify(logs)
+    
+    # Cursor da próxima página (só quando a página veio cheia)
+    if logs and len(logs) == limite:
+        ultimo = logs[-1]
+        if request.args.get('after_id') is not None:
+            resposta.headers['X-Proximo-After-Id'] = str(ultimo['id'])
+        else:
+            resposta.headers['X-Proximo-Before-Ts'] = str(ultimo['timestamp'])
+            resposta.headers['X-Proximo-Before-Id'] = str(ultimo['id'])
+    
+    return resposta
+
+@app.route('/api/allowlist')
+def obter_allowlist():
+    """UIDs ativos para validação offline no ESP32
+
+    since=<versao>: só as alterações desde essa versão (delta), ou o
+    snapshot completo se a versão for 0 ou antiga demais.
+    tipo=ordenado (padrão) ou bloom (sempre completo); formato=bin ou json.
+    """
+    desde = request.args.get('since', 0, type=int)
+    tipo = ALLOWLIST_BLOOM if request.args.get('tipo') == 'bloom' else ALLOWLIST_ORDENADO
+    formato = request.args.get('formato', 'bin')
+    
+    db = get_db()
+    versao = allowlist.versao(db)
+    if desde and desde == versao:
+        resposta = Response(status=304)
+        resposta.headers['X-Allowlist-Versao'] = str(versao)
+        return resposta
+    
+    delta = allowlist.delta(db, desde) if desde and tipo == ALLOWLIST_ORDENADO else None
+    
+    if delta is not None:
+        versao, adicionados, removidos = delta
+        if formato == 'json':
+            resposta = jsonify({'versao': versao, 'desde': desde, 'completo': False,
+                                'adicionados': adicionados, 'removidos': removidos})
+        else:
+            add = [b for b in map(uid_bytes, adicionados) if b is not None]
+            rem = [b for b in map(uid_bytes, removidos) if b is not None]
+            largura = largura_uids(add + rem)
+            dados = (ALLOWLIST_MAGICO
+                     + struct.pack('<BBHIIII', ALLOWLIST_DELTA, largura, 0, desde, versao, len(add), len(rem))
+                     + empacotar_uids(add, largura) + empacotar_uids(rem, largura))
+            resposta = Response(dados, mimetype='application/octet-stream')
+    elif formato == 'json':
+        linhas = db.execute('SELECT uid FROM usuarios WHERE ativo = 1 ORDER BY uid').fetchall()
+        resposta = jsonify({'versao': versao, 'completo': True, 'uids': [l['uid'] for l in linhas]})
+    else:
+        versao, dados = allowlist.snapshot(db, tipo)
+        resposta = Response(dados, mimetype='application/octet-stream')
+    
+    allowlist.compactar(db)
+    
+    resposta.headers['X-Allowlist-Versao'] = str(versao)
+    return resposta
+
+@app.route('/api/relatorios')
+@condicional('logs')
+def relatorios():
+    """Tempo de uso (logs.duracao) a partir dos rollups
+
+    desde/ate: timestamps; granularidade: hora, dia (padrão) ou total;
+    agrupar: machine_id, uid ou machine_id,uid (padrão);
+    machine_id/uid: filtros opcionais.
+    """
+    granularidade = request.args.get('granularidade', 'dia')
+    if granularidade not in ('hora', 'dia', 'total'):
+        return jsonify({'erro': 'granularidade deve ser hora, dia ou total'}), 400
+    
+    agrupar = [c for c in request.args.get('agrupar', 'machine_id,uid').split(',') if c]
+    if not agrupar or any(c not in ('machine_id', 'uid') for c in agrupar):
+        return jsonify({'erro': 'agrupar aceita machine_id e/ou uid'}), 400
+    
+    tabela, coluna = ('uso_horario', 'hora') if granularidade == 'hora' else ('uso_diario', 'dia')
+    colunas = list(agrupar)
+    if granularidade != 'total':
+        colunas.insert(0, f'{coluna} AS periodo')
+    
+    condicoes = []
+    params = []
+    desde = request.args.get('desde', type=int)
+    ate = request.args.get('ate', type=int)
+    if desde is not None:
+        condicoes.append(f'{coluna} >= ?')
+        params.append(desde)
+    if ate is not None:
+        condicoes.append(f'{coluna} <= ?')
+        params.append(ate)
+    for campo in ('machine_id', 'uid'):
+        valor = request.args.get(campo)
+        if valor:
+            condicoes.append(f'{campo} = ?')
+            params.append(valor)
+    
+    sql = f'SELECT {", ".join(colunas)}, SUM(segundos) AS segundos, SUM(eventos) AS eventos FROM {tabela}'
+    if condicoes:
+        sql += ' WHERE ' + ' AND '.join(condicoes)
+    grupo = ', '.join((['periodo'] if granularidade != 'total' else []) + agrupar)
+    sql += f' GROUP BY {grupo} ORDER BY {grupo}'
     
     db = get_db()
-    logs = db.execute(
-        'SELECT * FROM logs ORDER BY criado_em DESC LIMIT ?',
-        (limite,)
-    ).fetchall()
-    db.close()
+    linhas = db.execute(sql, params).fetchall()
     
-    return jsonify([dict(log) for log in logs])
+    resultado = []
+    for linha in linhas:
+        item = dict(linha)
+        item['horas'] = round(item['segundos'] / 3600, 2)
+        resultado.append(item)
+    
+    return jsonify(resultado)
+
+@app.route('/api/logs/retencao')
+def estado_retencao():
+    """Janela de retenção e arquivos de logs antigos"""
+    return jsonify(retencao.estado())
+
+@app.route('/api/backup/status')
+def estado_backup():
+    """Último snapshot (duração, tamanho, integridade) e arquivos guardados"""
+    return jsonify(backup.estado())
+
+@app.route('/metrics')
+def exportar_metricas():
+    """Métricas no formato Prometheus (?formato=json para o dashboard)"""
+    cache = cache_usuarios.estatisticas()
+    fila = fila_logs.estado()
+    extras = {
+        'cache_usuarios_hits_total': cache['hits'],
+        'cache_usuarios_misses_total': cache['misses'],
+        'cache_usuarios_tamanho': cache['tamanho'],
+        'fila_logs_profundidade': fila['profundidade'],
+        'fila_logs_rejeitados_total': fila['rejeitados'],
+        'logging_descartados_total': HandlerFilaSemBloqueio.descartados,
+        'sse_clientes': len(hub_eventos.clientes),
+        'db_conexoes_abertas': len(pool.todas),
+        'db_conexoes_livres': pool.livres.qsize(),
+        'streams_ativos': limite_streams.ativos,
+        'streams_recusados_total': limite_streams.recusados,
+    }
+    admissao = controle_admissao.estado()
+    for classe, total in admissao['em_andamento'].items():
+        extras[f'admissao_{classe}_em_andamento'] = total
+    for rejeicao in admissao['rejeitadas']:
+        extras[f"admissao_{rejeicao['classe']}_rejeitadas_{rejeicao['motivo']}_total"] = rejeicao['total']
+    if request.args.get('formato') == 'json':
+        return jsonify(metricas.json(extras))
+    return Response(metricas.prometheus(extras), mimetype='text/plain; version=0.0.4')
+
+@app.route('/api/admissao')
+def estado_admissao():
+    """Requisições em andamento, admitidas e descartadas por classe/motivo"""
+    return jsonify(controle_admissao.estado())
+
+@app.route('/api/cache')
+def estatisticas_cache():
+    """Estatísticas do cache de autorização"""
+    return jsonify(dict(cache_usuarios.estatisticas(), validades=agenda_validades.estado()))
+
+@app.route('/api/binario')
+def estado_binario():
+    """Contadores do protocolo binário de validação"""
+    return jsonify(servidor_binario.estado())
 
 @app.route('/api/maquinas')
+@condicional('maquinas')
 def listar_maquinas():
     """Listar máquinas"""
     db = get_db()
     maquinas = db.execute('SELECT * FROM maquinas ORDER BY nome').fetchall()
-    db.close()
     
     return jsonify([dict(m) for m in maquinas])
 
+@app.route('/api/heartbeat', methods=['POST'])
+def heartbeat():
+    """Sinal de vida da máquina - ESP32 envia periodicamente"""
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict) or not data.get('machine_id'):
+        return jsonify({'erro': 'Campo obrigatório ausente: machine_id'}), 400
+    if isinstance(data['machine_id'], (dict, list)):
+        return jsonify({'erro': 'Campo machine_id deve ser texto'}), 400
+    
+    firmware = data.get('firmware')
+    if firmware is not None and (not isinstance(firmware, str) or len(firmware) > FIRMWARE_MAX):
+        return jsonify({'erro': f'Campo firmware deve ser texto de até {FIRMWARE_MAX} caracteres'}), 400
+    try:
+        rssi = campo_inteiro(data, 'rssi', None) if data.get('rssi') is not None else None
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    
+    registro_maquinas.sinal(data['machine_id'], request.remote_addr, rssi, firmware)
+    return jsonify({'sucesso': True, 'timestamp': int(time.time())})
+
+@app.route('/api/maquinas/status')
+def status_maquinas():
+    """Online/offline da frota a partir do último sinal em memória"""
+    return jsonify(registro_maquinas.status())
+
+@app.route('/api/sessoes/ativas')
+def sessoes_ativas():
+    """Quem está operando cada máquina agora (?machine_id= para uma só)"""
+    return jsonify(indice_sessoes.ativas(request.args.get('machine_id')))
+
+CAMPOS_USUARIO = ('uid', 'nome', 'cargo', 'ativo', 'validade')
+
+SQL_UPSERT_USUARIO = '''INSERT INTO usuarios (uid, nome, cargo, ativo, validade) VALUES (?, ?, ?, ?, ?)
+                        ON CONFLICT(uid) DO UPDATE SET
+                            nome = excluded.nome,
+                            cargo = excluded.cargo,
+                            ativo = excluded.ativo,
+                            validade = excluded.validade'''
+
+def normalizar_validade(validade):
+    """Timestamp (int) de expiração do crachá, ou None para sem validade"""
+    if validade in ('', None):
+        return None
+    if isinstance(validade, bool):
+        raise ValueError(f'Validade deve ser um timestamp: {validade}')
+    try:
+        validade = int(validade)
+    except (TypeError, ValueError, OverflowError):
+        raise ValueError(f'Validade deve ser um timestamp: {validade}')
+    if not 0 <= validade <= VALIDADE_MAX:
+        raise ValueError(f'Validade fora do intervalo (0 a {VALIDADE_MAX})')
+    return validade
+
+def normalizar_usuario(dados):
+    """Linha de importação (CSV ou JSON) → tupla de CAMPOS_USUARIO"""
+    if not isinstance(dados, dict):
+        raise ValueError('Linha deve ser um objeto')
+    for campo in CAMPOS_USUARIO:
+        if isinstance(dados.get(campo), (dict, list)):
+            raise ValueError(f'Campo {campo} deve ser um valor simples')
+    uid = str(dados.get('uid') or '').strip().upper()
+    nome = str(dados.get('nome') or '').strip()
+    if not uid or not nome:
+        raise ValueError('UID e nome são obrigatórios')
+    
+    ativo = dados.get('ativo', 1)
+    if isinstance(ativo, str):
+        texto = ativo.strip().lower()
+        if texto in ('', '1', 'true', 'sim', 's', 'ativo'):
+            ativo = 1
+        elif texto in ('0', 'false', 'nao', 'não', 'n', 'inativo'):
+            ativo = 0
+        else:
+            raise ValueError(f'Valor inválido para ativo: {ativo}')
+    ativo = 1 if ativo else 0
+    
+    validade = normalizar_validade(dados.get('validade'))
+    return (uid, nome, str(dados.get('cargo') or '').strip(), ativo, validade)
+
+def receber_importacao():
+    """Copiar o corpo para um arquivo temporário antes da transação
+
+    Um upload lento pela rede não segura o lock de escrita. Retorna o
+    arquivo no início; ValueError se o conteúdo não for UTF-8.
+    """
+    arquivo = tempfile.TemporaryFile()
+    try:
+        decodificador = codecs.getincrementaldecoder('utf-8')()
+        linha = 1
+        while True:
+            bloco = request.stream.read(IMPORTACAO_BLOCO_BYTES)
+            if not bloco:
+                break
+            try:
+                decodificador.decode(bloco)
+            except UnicodeDecodeError as e:
+                linha += bloco[:e.start].count(b'\n')
+                raise ValueError(f'Arquivo não está em UTF-8 (linha {linha})')
+            linha += bloco.count(b'\n')
+            arquivo.write(bloco)
+        try:
+            decodificador.decode(b'', final=True)
+        except UnicodeDecodeError:
+            raise ValueError(f'Arquivo não está em UTF-8 (linha {linha})')
+        arquivo.seek(0)
+        return arquivo
+    except Exception:
+        arquivo.close()
+        raise
+
+def ler_importacao(arquivo, formato):
+    """Iterar as linhas do arquivo recebido sem carregá-lo todo"""
+    texto = io.TextIOWrapper(arquivo, encoding='utf-8-sig', newline='')
+    if formato == 'csv':
+        leitor = csv.DictReader(texto)
+        while True:
+            try:
+                linha = next(leitor)
+            except StopIteration:
+                break
+            except csv.Error as e:
+                # O leitor já consumiu a linha com problema e segue na próxima
+                yield ValueError(f'CSV inválido: {e}')
+                continue
+            yield linha
+    else:
+        for numero, linha in enumerate(texto, 1):
+            if not linha.strip():
+                continue
+            try:
+                yield json.loads(linha)
+            except ValueError:
+                yield ValueError(f'JSON inválido na linha {numero}')
+
+@app.route('/api/usuarios/import', methods=['POST'])
+def importar_usuarios():
+    """Importar usuários em massa (CSV ou NDJSON) com upsert transacional
+
+    CSV com cabeçalho uid,nome,cargo,ativo,validade; ou um objeto JSON
+    por linha. Tudo em uma transação: ou entra o arquivo inteiro
+    (menos as linhas com erro), ou nada.
+    """
+    formato = request.args.get('formato')
+    if formato is None:
+        formato = 'csv' if 'csv' in (request.mimetype or '') else 'ndjson'
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'erro': 'formato deve ser csv ou ndjson'}), 400
+    
+    try:
+        arquivo = receber_importacao()
+    except ValueError as e:
+        return jsonify({'erro': str(e)}), 400
+    
+    db = get_db()
+    db.execute('BEGIN IMMEDIATE')
+    total_antes = ler_contadores(db).get('usuarios', 0)
+    
+    processadas = 0
+    erros = []
+    total_erros = 0
+    bloco = []
+    try:
+        for numero, dados in enumerate(ler_importacao(arquivo, formato), 1):
+            processadas += 1
+            try:
+                if isinstance(dados, ValueError):
+                    raise dados
+                bloco.append(normalizar_usuario(dados))
+            except ValueError as e:
+                total_erros += 1
+                if len(erros) < IMPORTACAO_ERROS_MAX:
+                    erros.append({'linha': numero, 'erro': str(e)})
+                continue
+            if len(bloco) >= IMPORTACAO_BLOCO:
+                db.executemany(SQL_UPSERT_USUARIO, bloco)
+                bloco = []
+        if bloco:
+            db.executemany(SQL_UPSERT_USUARIO, bloco)
+        
+        inseridos = ler_contadores(db).get('usuarios', 0) - total_antes
+        db.commit()
+    except Exception:
+        db.rollback()
+        raise
+    finally:
+        arquivo.close()
+    
+    # Uma única atualização de cache/versões para o lote inteiro
+    versoes.incrementar('usuarios')
+    agenda_validades.carregar()
+    cache_usuarios.carregar()
+    
+    gravadas = processadas - total_erros
+    registrar(logging.INFO, 'usuarios_importados',
+              f'📥 Importação: {gravadas} usuários ({inseridos} novos, {total_erros} erros)',
+              gravados=gravadas, inseridos=inseridos, erros=total_erros)
+    return jsonify({
+        'sucesso': total_erros == 0,
+        'processadas': processadas,
+        'inseridos': inseridos,
+        'atualizados': gravadas - inseridos,
+        'total_erros': total_erros,
+        'erros': erros
+    })
+
+@app.route('/api/usuarios/export')
+def exportar_usuarios():
+    """Exportar usuários em CSV (padrão) ou NDJSON, em stream"""
+    formato = request.args.get('formato', 'csv')
+    if formato not in ('csv', 'ndjson'):
+        return jsonify({'erro': 'formato deve ser csv ou ndjson'}), 400
+    
+    linhas = linhas_banco(f'SELECT {", ".join(CAMPOS_USUARIO)} FROM usuarios ORDER BY uid', [])
+    
+    if formato == 'ndjson':
+        return resposta_stream(lambda: stream_logs(linhas, 'ndjson'), mimetype='application/x-ndjson')
+    
+    def gerar_csv():
+        saida = io.StringIO()
+        escritor = csv.writer(saida)
+        escritor.writerow(CAMPOS_USUARIO)
+        while True:
+            bloco = list(islice(linhas, LOGS_STREAM_BLOCO))
+            if not bloco:
+                break
+            escritor.writerows([linha[c] for c in CAMPOS_USUARIO] for linha in bloco)
+            yield saida.getvalue()
+            saida.seek(0)
+            saida.truncate()
+        if saida.tell():
+            yield saida.getvalue()
+    
+    resposta = resposta_stream(gerar_csv, mimetype='text/csv')
+    if resposta.status_code == 200:
+        resposta.headers['Content-Disposition'] = 'attachment; filename=usuarios.csv'
+    return resposta
+
 @app.route('/api/usuarios/<int:user_id>', methods=['DELETE'])
 def deletar_usuario(user_id):
     """Deletar usuário"""
     db = get_db()
+    usuario = db.execute('SELECT uid FROM usuarios WHERE id = ?', (user_id,)).fetchone()
     db.execute('DELETE FROM usuarios WHERE id = ?', (user_id,))
     db.commit()
-    db.close()
+    versoes.incrementar('usuarios')
+    
+    if usuario:
+        cache_usuarios.remover(usuario['uid'])
     
-    print(f"🗑️ Usuário {user_id} deletado")
+    registrar(logging.INFO, 'usuario_deletado', f"🗑️ Usuário {user_id} deletado", id=user_id)
     return jsonify({'sucesso': True, 'mensagem': 'Usuário deletado'})
 
 @app.route('/dashboard')
 def dashboard():
     """Dashboard HTML completo"""
-    html = '''
-    <!DOCTYPE html>
-    <html>
-    <head>
-        <title>Dashboard - Controle de Acesso</title>
-        <meta name="viewport" content="width=device-width, initial-scale=1">
-        <meta charset="utf-8">
-        <style>
-            * { margin: 0; padding: 0; box-sizing: border-box; }
-            body { 
-                font-family: Arial; 
-                background: #1a1a2e;
-                color: #eee;
-                padding: 20px;
-            }
-            .container { max-width: 1400px; margin: 0 auto; }
-            h1 { margin-bottom: 30px; color: #4ecca3; text-align: center; }
-            .grid { 
-                display: grid; 
-                grid-template-columns: repeat(auto-fit, minmax(350px, 1fr));
-                gap: 20px;
-                margin-bottom: 30px;
-            }
-            .card {
-                background: #16213e;
-                padding: 20px;
-                border-radius: 10px;
-                box-shadow: 0 4px 6px rgba(0,0,0,0.3);
-            }
-            .card h2 { 
-                color: #4ecca3; 
-                margin-bottom: 15px;
-                font-size: 1.3em;
-            }
-            table {
-                width: 100%;
-                border-collapse: collapse;
-                margin-top: 10px;
-            }
-            th, td {
-                padding: 12px 8px;
-                text-align: left;
-                border-bottom: 1px solid #0f3460;
-            }
-            th { 
-                background: #0f3460; 
-                color: #4ecca3;
-                font-weight: bold;
-            }
-            tr:hover { background: #0f3460; }
-            .badge {
-                display: inline-block;
-                padding: 5px 10px;
-                border-radius: 4px;
-                font-size: 0.85em;
-                font-weight: bold;
-            }
-            .ativo { background: #4ecca3; color: #000; }
-            .inativo { background: #e74c3c; color: #fff; }
-            .btn {
-                background: #4ecca3;
-                color: #000;
-                border: none;
-                padding: 10px 20px;
-                border-radius: 5px;
-                cursor: pointer;
-                font-weight: bold;
-                margin: 5px;
-            }
-            .btn:hover { background: #45b393; }
-            .btn-delete { background: #e74c3c; color: #fff; }
-            #logs { max-height: 500px; overflow-y: auto; }
-            .form-add {
-                background: #0f3460;
-                padding: 15px;
-                border-radius: 5px;
-                margin-bottom: 15px;
-            }
-            .form-add input {
-                padding: 8px;
-                margin: 5px;
-                border: none;
-                border-radius: 3px;
-                background: #16213e;
-                color: #fff;
-            }
-        </style>
-    </head>
-    <body>
-        <div class="container">
-            <h1>🔐 Dashboard - Sistema de Controle de Acesso</h1>
-            
-            <div class="grid">
-                <div class="card">
-                    <h2>👥 Usuários Cadastrados</h2>
-                    <div class="form-add">
-                        <input type="text" id="novoUid" placeholder="UID (ex: FA089CBC)" maxlength="8">
-                        <input type="text" id="novoNome" placeholder="Nome completo">
-                        <input type="text" id="novoCargo" placeholder="Cargo">
-                        <button class="btn" onclick="adicionarUsuario()">➕ Adicionar</button>
-                    </div>
-                    <div id="usuarios">Carregando...</div>
-                </div>
-                
-                <div class="card">
-                    <h2>🏭 Máquinas Cadastradas</h2>
-                    <div id="maquinas">Carregando...</div>
-                </div>
-            </div>
-            
-            <div class="card">
-                <h2>📊 Logs Recentes</h2>
-                <button class="btn" onclick="carregarLogs()">🔄 Atualizar</button>
-                <div id="logs">Carregando...</div>
-            </div>
-        </div>
-        
-        <script>
-            function carregarUsuarios() {
-                fetch('/api/usuarios')
-                    .then(r => r.json())
-                    .then(data => {
-                        let html = '<table><tr><th>UID</th><th>Nome</th><th>Cargo</th><th>Status</th><th>Ações</th></tr>';
-                        data.forEach(u => {
-                            html += `<tr>
-                                <td><strong>${u.uid}</strong></td>
-                                <td>${u.nome}</td>
-                                <td>${u.cargo || '-'}</td>
-                                <td><span class="badge ${u.ativo ? 'ativo' : 'inativo'}">${u.ativo ? 'ATIVO' : 'INATIVO'}</span></td>
-                                <td><button class="btn btn-delete" onclick="deletarUsuario(${u.id})">🗑️</button></td>
-                            </tr>`;
-                        });
-                        html += '</table>';
-                        document.getElementById('usuarios').innerHTML = html;
-                    });
-            }
-            
-            function carregarMaquinas() {
-                fetch('/api/maquinas')
-                    .then(r => r.json())
-                    .then(data => {
-                        let html = '<table><tr><th>ID</th><th>Nome</th><th>Local</th><th>Status</th></tr>';
-                        data.forEach(m => {
-                            html += `<tr>
-                                <td><strong>${m.machine_id}</strong></td>
-                                <td>${m.nome}</td>
-                                <td>${m.local || '-'}</td>
-                                <td><span class="badge ${m.ativa ? 'ativo' : 'inativo'}">${m.ativa ? 'ATIVA' : 'INATIVA'}</span></td>
-                            </tr>`;
-                        });
-                        html += '</table>';
-                        document.getElementById('maquinas').innerHTML = html;
-                    });
-            }
-            
-            function carregarLogs() {
-                fetch('/api/logs?limite=50')
-                    .then(r => r.json())
-                    .then(data => {
-                        let html = '<table><tr><th>Data/Hora</th><th>Máquina</th><th>Usuário</th><th>Evento</th><th>RSSI</th></tr>';
-                        data.forEach(log => {
-                            const data = new Date(log.timestamp * 1000).toLocaleString('pt-BR');
-                            html += `<tr>
-                                <td>${data}</td>
-                                <td>${log.machine_id}</td>
-                                <td>${log.usuario || log.uid}</td>
-                                <td>${log.evento}</td>
-                                <td>${log.rssi ? log.rssi + ' dBm' : '-'}</td>
-                            </tr>`;
-                        });
-                        html += '</table>';
-                        document.getElementById('logs').innerHTML = html;
-                    });
-            }
-            
-            function adicionarUsuario() {
-                const uid = document.getElementById('novoUid').value.toUpperCase();
-                const nome = document.getElementById('novoNome').value;
-                const cargo = document.getElementById('novoCargo').value;
-                
-                if (!uid || !nome) {
-                    alert('Preencha UID e Nome!');
-                    return;
-                }
-                
-                fetch('/api/usuarios', {
-                    method: 'POST',
-                    headers: { 'Content-Type': 'application/json' },
-                    body: JSON.stringify({ uid, nome, cargo })
-                })
-                .then(r => r.json())
-                .then(data => {
-                    if (data.sucesso) {
-                        alert('✅ Usuário cadastrado!');
-                        document.getElementById('novoUid').value = '';
-                        document.getElementById('novoNome').value = '';
-                        document.getElementById('novoCargo').value = '';
-                        carregarUsuarios();
-                    } else {
-                        alert('❌ ' + data.erro);
-                    }
-                });
-            }
-            
-            function deletarUsuario(id) {
-                if (!confirm('Deletar este usuário?')) return;
-                
-                fetch('/api/usuarios/' + id, { method: 'DELETE' })
-                    .then(() => carregarUsuarios());
-            }
-            
-            carregarUsuarios();
-            carregarMaquinas();
-            carregarLogs();
-            
-            setInterval(carregarLogs, 10000);
-        </script>
-    </body>
-    </html>
-    '''
-    return html
+    return paginas.servir('dashboard.html')
+
+@app.route('/static/<nome>')
+def arquivo_estatico(nome):
+    """CSS/JS das páginas; com hash no nome fica em cache por um ano"""
+    return paginas.servir(nome)
 
 # ==================== INICIAR SERVIDOR ====================
 
+def iniciar_servicos():
+    """Banco, caches e threads de fundo (comum aos dois modos de execução)"""
+    init_db()
+    paginas.carregar()
+    retencao.iniciar()
+    backup.iniciar()
+    agenda_validades.carregar()  # Antes do cache: crachás vencidos com o servidor parado
+    agenda_validades.iniciar()
+    cache_usuarios.carregar()
+    registro_maquinas.carregar()
+    registro_maquinas.iniciar()
+    indice_sessoes.carregar()
+    indice_sessoes.iniciar()
+    servidor_binario.iniciar()
+    if LOG_ESCRITA_ATRASADA:
+        fila_logs.iniciar()
+
+def servir_producao(porta, threads):
+    """Servir com waitress (WSGI puro Python, roda no Termux)
+
+    Processo único com várias threads: cache, fila de logs, hub SSE e
+    versões de ETag ficam coerentes sem coordenação entre processos.
+    """
+    try:
+        from waitress import create_server
+    except ImportError:
+        print('❌ Modo produção requer o waitress: pip install waitress')
+        raise SystemExit(1)
+    
+    controle_admissao.capacidade = threads
+    pool.redimensionar(threads + DB_POOL_RESERVA)
+    limite_streams.limite = max(1, threads // 4)
+    servidor = create_server(
+        app,
+        host='0.0.0.0',
+        port=porta,
+        threads=threads,
+        connection_limit=PRODUCAO_CONEXOES,
+        backlog=PRODUCAO_BACKLOG,
+        channel_timeout=PRODUCAO_KEEPALIVE,
+        ident='controle-acesso'
+    )
+    
+    parar = threading.Event()
+    
+    def encerrar(signum, frame):
+        parar.set()
+    signal.signal(signal.SIGTERM, encerrar)
+    signal.signal(signal.SIGINT, encerrar)
+    
+    def girar(timeout):
+        servidor.asyncore.loop(timeout=timeout, map=servidor._map, count=1)
+    
+    while not parar.is_set():
+        girar(1)
+    
+    # Desligamento gracioso: parar de aceitar, terminar streams SSE e
+    # continuar girando o loop até as respostas em andamento saírem
+    print('\n🛑 Encerrando: aguardando requisições em andamento...')
+    servidor.accepting = False
+    hub_eventos.encerrar()
+    despachante = servidor.task_dispatcher
+    prazo = time.monotonic() + PRODUCAO_ENCERRAR
+    while time.monotonic() < prazo:
+        pendente = despachante.queue or despachante.active_count or any(
+            getattr(canal, 'total_outbufs_len', 0) for canal in list(servidor._map.values())
+        )
+        if not pendente:
+            break
+        girar(0.1)
+    despachante.shutdown(cancel_pending=True, timeout=1)
+    servidor.close()
+    # A fila de logs e o pool de conexões são fechados pelo atexit
+
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Servidor de controle de acesso')
+    parser.add_argument('--reconciliar-contadores', action='store_true',
+                        help='recalcular os contadores da página inicial e sair')
+    parser.add_argument('--producao', action='store_true',
+                        help='servir com waitress (várias threads) em vez do servidor de desenvolvimento')
+    parser.add_argument('--threads', type=int, default=PRODUCAO_THREADS,
+                        help=f'threads de atendimento no modo produção (padrão: {PRODUCAO_THREADS})')
+    parser.add_argument('--porta', type=int, default=PORT,
+                        help=f'porta HTTP (padrão: {PORT})')
+    args = parser.parse_args()
+    PORT = args.porta
+    
+    if args.reconciliar_contadores:
+        init_db()
+        for tabela, diferenca in reconciliar_contadores().items():
+            print(f'🔢 {tabela}: {diferenca:+d}')
+        raise SystemExit(0)
+    
     print('\n╔════════════════════════════════════════════════════╗')
     print('║  🚀 SERVIDOR DE CONTROLE DE ACESSO - PYTHON       ║')
     print('╚════════════════════════════════════════════════════╝\n')
     
-    # Inicializar banco de dados
+    # Inicializar banco de dados e aplicar migrações pendentes
     if not os.path.exists(DATABASE):
         print('📦 Criando banco de dados...')
-        init_db()
     else:
         print('✅ Banco de dados já existe')
+    iniciar_servicos()
     
-    print(f'\n✅ Servidor Flask rodando na porta {PORT}')
+    print(f'⚡ Cache de autorização: {len(cache_usuarios.dados)} usuários em memória')
+    if PORTA_BINARIA is not None:
+        print(f'📡 Protocolo binário (UDP/TCP) na porta {PORTA_BINARIA}')
+    
+    modo = f'waitress, {args.threads} threads' if args.producao else 'Flask (desenvolvimento)'
+    print(f'\n✅ Servidor rodando na porta {PORT} [{modo}]')
     print(f'🌐 Acesse: http://localhost:{PORT}')
     print(f'📱 Dashboard: http://localhost:{PORT}/dashboard')
     print('\n📋 Pressione Ctrl+C para parar o servidor\n')
     
     # Iniciar servidor
-    app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
+    if args.producao:
+        servir_producao(PORT, args.threads)
+    else:
+        app.run(host='0.0.0.0', port=PORT, debug=False)
\ No newline at end of file
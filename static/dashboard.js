@@ -0,0 +1,171 @@
+const USUARIOS_POR_PAGINA = 50;
+let buscaUsuarios = '';
+let proximoUsuarios = null;  // Cursor (nome, id) da próxima página
+let consultaUsuarios = 0;    // Descarta respostas de buscas já substituídas
+let esperaBusca = null;
+
+function linhaUsuario(u) {
+    return `<tr>
+        <td><strong>${u.uid}</strong></td>
+        <td>${u.nome}</td>
+        <td>${u.cargo || '-'}</td>
+        <td><span class="badge ${u.ativo ? 'ativo' : 'inativo'}">${u.ativo ? 'ATIVO' : 'INATIVO'}</span></td>
+        <td><button class="btn btn-delete" onclick="deletarUsuario(${u.id})">🗑️</button></td>
+    </tr>`;
+}
+
+// Busca uma página por vez; "continuar" acrescenta a próxima à tabela
+function carregarUsuarios(continuar) {
+    const consulta = continuar ? consultaUsuarios : ++consultaUsuarios;
+    const busca = buscaUsuarios ? '&q=' + encodeURIComponent(buscaUsuarios) : '';
+    let url = '/api/usuarios?limite=' + USUARIOS_POR_PAGINA + busca;
+    if (continuar && proximoUsuarios) {
+        url += '&after_nome=' + encodeURIComponent(proximoUsuarios.nome) + '&after_id=' + proximoUsuarios.id;
+    }
+    
+    fetch(url)
+        .then(r => {
+            const nome = r.headers.get('X-Proximo-After-Nome');
+            const cursor = nome === null ? null : {nome: decodeURIComponent(nome), id: r.headers.get('X-Proximo-After-Id')};
+            return r.json().then(data => ({data, cursor}));
+        })
+        .then(({data, cursor}) => {
+            if (consulta !== consultaUsuarios) return;
+            proximoUsuarios = cursor;
+            if (!continuar) {
+                document.getElementById('usuarios').innerHTML =
+                    '<table><thead><tr><th>UID</th><th>Nome</th><th>Cargo</th><th>Status</th><th>Ações</th></tr></thead>' +
+                    '<tbody id="usuariosCorpo"></tbody></table>';
+            }
+            document.getElementById('usuariosCorpo').insertAdjacentHTML('beforeend', data.map(linhaUsuario).join(''));
+            document.getElementById('maisUsuarios').style.display = cursor ? '' : 'none';
+        });
+    
+    if (!continuar) {
+        fetch('/api/usuarios?contar=1' + busca)
+            .then(r => r.json())
+            .then(data => {
+                if (consulta !== consultaUsuarios) return;
+                document.getElementById('totalUsuarios').textContent = data.total;
+            });
+    }
+}
+
+function buscarUsuarios() {
+    clearTimeout(esperaBusca);
+    esperaBusca = setTimeout(() => {
+        buscaUsuarios = document.getElementById('buscaUsuarios').value.trim();
+        carregarUsuarios(false);
+    }, 300);
+}
+
+function carregarMaquinas() {
+    fetch('/api/maquinas')
+        .then(r => r.json())
+        .then(data => {
+            let html = '<table><tr><th>ID</th><th>Nome</th><th>Local</th><th>Status</th></tr>';
+            data.forEach(m => {
+                html += `<tr>
+                    <td><strong>${m.machine_id}</strong></td>
+                    <td>${m.nome}</td>
+                    <td>${m.local || '-'}</td>
+                    <td><span class="badge ${m.ativa ? 'ativo' : 'inativo'}">${m.ativa ? 'ATIVA' : 'INATIVA'}</span></td>
+                </tr>`;
+            });
+            html += '</table>';
+            document.getElementById('maquinas').innerHTML = html;
+        });
+}
+
+const LOGS_VISIVEIS = 50;
+let ultimoLogId = 0;
+let streamLogs = null;
+
+function linhaLog(log) {
+    const data = new Date(log.timestamp * 1000).toLocaleString('pt-BR');
+    return `<tr>
+        <td>${data}</td>
+        <td>${log.machine_id}</td>
+        <td>${log.usuario || log.uid}</td>
+        <td>${log.evento}</td>
+        <td>${log.rssi ? log.rssi + ' dBm' : '-'}</td>
+    </tr>`;
+}
+
+function carregarLogs() {
+    fetch('/api/logs?limite=' + LOGS_VISIVEIS)
+        .then(r => r.json())
+        .then(data => {
+            let html = '<table><thead><tr><th>Data/Hora</th><th>Máquina</th><th>Usuário</th><th>Evento</th><th>RSSI</th></tr></thead><tbody id="logsCorpo">';
+            data.forEach(log => {
+                html += linhaLog(log);
+                ultimoLogId = Math.max(ultimoLogId, log.id);
+            });
+            html += '</tbody></table>';
+            document.getElementById('logs').innerHTML = html;
+            iniciarStreamLogs();
+        });
+}
+
+// Recebe só os logs novos via SSE em vez de recarregar a tabela
+function iniciarStreamLogs() {
+    if (streamLogs) return;
+    if (!window.EventSource) {
+        setInterval(carregarLogs, 10000);
+        streamLogs = true;
+        return;
+    }
+    streamLogs = new EventSource('/api/logs/stream?ultimo_id=' + ultimoLogId);
+    streamLogs.addEventListener('log', e => {
+        const log = JSON.parse(e.data);
+        if (log.id <= ultimoLogId) return;
+        ultimoLogId = log.id;
+
+        const corpo = document.getElementById('logsCorpo');
+        if (!corpo) return;
+        corpo.insertAdjacentHTML('afterbegin', linhaLog(log));
+        while (corpo.rows.length > LOGS_VISIVEIS) {
+            corpo.deleteRow(-1);
+        }
+    });
+}
+
+function adicionarUsuario() {
+    const uid = document.getElementById('novoUid').value.toUpperCase();
+    const nome = document.getElementById('novoNome').value;
+    const cargo = document.getElementById('novoCargo').value;
+
+    if (!uid || !nome) {
+        alert('Preencha UID e Nome!');
+        return;
+    }
+
+    fetch('/api/usuarios', {
+        method: 'POST',
+        headers: { 'Content-Type': 'application/json' },
+        body: JSON.stringify({ uid, nome, cargo })
+    })
+    .then(r => r.json())
+    .then(data => {
+        if (data.sucesso) {
+            alert('✅ Usuário cadastrado!');
+            document.getElementById('novoUid').value = '';
+            document.getElementById('novoNome').value = '';
+            document.getElementById('novoCargo').value = '';
+            carregarUsuarios(false);
+        } else {
+            alert('❌ ' + data.erro);
+        }
+    });
+}
+
+function deletarUsuario(id) {
+    if (!confirm('Deletar este usuário?')) return;
+
+    fetch('/api/usuarios/' + id, { method: 'DELETE' })
+        .then(() => carregarUsuarios(false));
+}
+
+carregarUsuarios(false);
+carregarMaquinas();
+carregarLogs();
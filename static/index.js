@@ -0,0 +1,9 @@
+// Só os contadores são dinâmicos; o resto da página vem do cache do navegador
+fetch('/api/estatisticas')
+    .then(r => r.json())
+    .then(data => {
+        document.getElementById('porta').textContent = data.porta;
+        document.getElementById('total-usuarios').textContent = data.usuarios;
+        document.getElementById('total-maquinas').textContent = data.maquinas;
+        document.getElementById('total-logs').textContent = data.logs;
+    });
@@ -0,0 +1,145 @@
+// Dados simulados em memória
+let usuarios = [
+    {nome: "João Silva", uid: "F1B2715B", cargo: "Operador Senior", ativo: true},
+    {nome: "Maria Santos", uid: "04A1B2C3", cargo: "Técnica", ativo: true},
+    {nome: "Pedro Costa", uid: "04D4E5F6", cargo: "Auxiliar", ativo: false}
+];
+
+let maquinas = [
+    {id: "TORNO-01", tipo: "Torno", setor: "Usinagem A", risco: "Alto", online: true},
+    {id: "FURADEIRA-03", tipo: "Furadeira", setor: "Usinagem B", risco: "Médio", online: true},
+    {id: "SERRA-02", tipo: "Serra Circular", setor: "Corte", risco: "Alto", online: false}
+];
+
+let logs = [];
+
+// Navegação entre tabs
+function showTab(tabName) {
+    // Esconder todos os conteúdos
+    document.querySelectorAll('.content').forEach(content => {
+        content.classList.remove('active');
+    });
+    
+    // Remover active de todas as tabs
+    document.querySelectorAll('.tab').forEach(tab => {
+        tab.classList.remove('active');
+    });
+    
+    // Mostrar conteúdo selecionado
+    document.getElementById(tabName).classList.add('active');
+    
+    // Ativar tab clicada
+    event.target.classList.add('active');
+}
+
+// Adicionar usuário
+function adicionarUsuario() {
+    const nome = document.getElementById('nomeUsuario').value;
+    const uid = document.getElementById('uidCartao').value;
+    const cargo = document.getElementById('cargoUsuario').value;
+    const status = document.getElementById('statusUsuario').value;
+
+    if (!nome || !uid) {
+        alert('Por favor, preencha nome e UID do cartão!');
+        return;
+    }
+
+    usuarios.push({
+        nome: nome,
+        uid: uid.toUpperCase(),
+        cargo: cargo,
+        ativo: status === 'ativo'
+    });
+
+    // Limpar formulário
+    document.getElementById('nomeUsuario').value = '';
+    document.getElementById('uidCartao').value = '';
+    document.getElementById('cargoUsuario').value = '';
+
+    atualizarListaUsuarios();
+    alert('Usuário adicionado com sucesso!');
+}
+
+// Atualizar lista de usuários
+function atualizarListaUsuarios() {
+    const tbody = document.getElementById('listaUsuarios');
+    tbody.innerHTML = '';
+
+    usuarios.forEach((usuario, index) => {
+        const tr = document.createElement('tr');
+        tr.innerHTML = `
+            <td>${usuario.nome}</td>
+            <td>${usuario.uid}</td>
+            <td>${usuario.cargo}</td>
+            <td><span class="status ${usuario.ativo ? 'active' : 'inactive'}">
+                ${usuario.ativo ? 'Ativo' : 'Inativo'}
+            </span></td>
+            <td class="actions">
+                <button class="btn-small ${usuario.ativo ? 'btn-danger' : 'btn-success'}" 
+                        onclick="toggleUsuario(${index})">
+                    ${usuario.ativo ? 'Desativar' : 'Ativar'}
+                </button>
+            </td>
+        `;
+        tbody.appendChild(tr);
+    });
+
+    document.getElementById('totalUsuarios').textContent = usuarios.length;
+}
+
+// Toggle status do usuário
+function toggleUsuario(index) {
+    usuarios[index].ativo = !usuarios[index].ativo;
+    atualizarListaUsuarios();
+}
+
+// Adicionar máquina
+function adicionarMaquina() {
+    const nome = document.getElementById('nomeMaquina').value;
+    const tipo = document.getElementById('tipoMaquina').value;
+    const setor = document.getElementById('setorMaquina').value;
+    const risco = document.getElementById('riscoMaquina').value;
+
+    if (!nome) {
+        alert('Por favor, preencha o nome da máquina!');
+        return;
+    }
+
+    maquinas.push({
+        id: nome.toUpperCase(),
+        tipo: tipo,
+        setor: setor,
+        risco: risco,
+        online: false
+    });
+
+    document.getElementById('nomeMaquina').value = '';
+    atualizarListaMaquinas();
+    alert('Máquina cadastrada com sucesso!');
+}
+
+// Atualizar lista de máquinas
+function atualizarListaMaquinas() {
+    const tbody = document.getElementById('listaMaquinas');
+    tbody.innerHTML = '';
+
+    maquinas.forEach((maquina, index) => {
+        const tr = document.createElement('tr');
+        tr.innerHTML = `
+            <td>${maquina.id}</td>
+            <td>${maquina.tipo}</td>
+            <td>${maquina.setor}</td>
+            <td><span class="status ${maquina.risco === 'Alto' ? 'warning' : 'active'}">${maquina.risco}</span></td>
+            <td><span class="status ${maquina.online ? 'active' : 'inactive'}">
+                ${maquina.online ? 'Online' : 'Offline'}
+            </span></td>
+            <td class="actions">
+                <button class="btn-small btn-success">Configurar</button>
+                <button class="btn-small">Histórico</button>
+            </td>
+        `;
+        tbody.appendChild(tr);
+    });
+
+    document.getElementById('maquinasAtivas').textContent = maquinas.filter(m => m.online).length;
+}